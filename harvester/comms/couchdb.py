@@ -4,59 +4,128 @@
 Classes inherited from DatabaseComms encapsulate database
 communications. This is designed so that the database software can be
 changed seamlessly without having to modify the rest of the codebase.
+
+Every CouchDBComms in a process shares one couchdb.Server, and so one
+pool of connections to the server. Each database is opened the first
+time it's used and its design document is updated at most once per
+process. The bundled MapReduce views are read once at import.
 """
 
 import sys
 import os
 import json
+import hashlib
 import yaml
+import time
+import atexit
+import weakref
+import threading
 
 import couchdb
 
 import core
 
 
-class DatabaseComms:
+def _load_views():
+    """Reads the MapReduce .js files bundled with the project.
 
-    def __init__(self, db_str):
-        """"""
-        self.db_str = db_str
-        self.connect()
+    Returns:
+        dict: The views of each design document, by its name (the
+            prefix of the file names, e.g. 'tweets').
+    """
+    views = {}
+    dir_path = os.path.join(
+        os.path.dirname(os.path.realpath(__file__)),
+        'mapreduce'
+    )
+    for file in sorted(os.listdir(dir_path)):
+        if not file.endswith('.js'):
+            continue
+        view_cat, filename = file.split('_', 1)
+        # e.g. users_since_id.map.js
+        view, kind = os.path.splitext(os.path.splitext(filename)[0])
+        if kind not in ('.map', '.reduce'):
+            continue
+        with open(os.path.join(dir_path, file)) as f:
+            views.setdefault(view_cat, {}).setdefault(view, {})[kind[1:]] = \
+                f.read()
+    return views
 
-    def connect(self):
-        """"""
 
+def _views_hash(views):
+    """Returns a fingerprint of the views of a design document."""
+    data = json.dumps(views, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
 
-class CouchDBComms(DatabaseComms):
-    """"""
 
-    def connect(self):
-        """"""
-        args = core.config('couchdb')
-        # Construct a URL from the arguments
-        protocol = 'http'
-        if 'https' in args:
-            if args['https'] is True:
-                protocol = 'https'
-        # Create a safe URL that we can print (omits login/password)
-        url = url_safe = '{protocol}://{ip}:{port}/'.format(
+# The views of each design document, read once at import
+VIEWS = _load_views()
+
+# The process-wide CouchDB server and database handles, shared by
+# every CouchDBComms. See get_server() and get_database()
+_server = None
+_databases = {}
+# The databases whose design documents are up to date
+_synced = set()
+# The views being rebuilt under a staging design document, by
+# database. See CouchDBComms.stage_views()
+_staged = {}
+STAGING_SUFFIX = '_staging'
+# More than the rounding error of a tweet ID (< 2^63) as a double. See
+# CouchDBComms.get_since_ids()
+SINCE_ID_MARGIN = 1024
+_registry_lock = threading.RLock()
+# The CouchDBComms that may have buffered docs, flushed at shutdown
+_live = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_all():
+    """Makes sure nothing is left in a write buffer on shutdown."""
+    for comms in list(_live):
+        comms.flush()
+
+
+def _server_urls():
+    """Returns the URL of the CouchDB server and a safe URL that we can
+    print (omits login/password).
+    """
+    args = core.config('couchdb')
+    # Construct a URL from the arguments
+    protocol = 'http'
+    if 'https' in args:
+        if args['https'] is True:
+            protocol = 'https'
+    url = url_safe = '{protocol}://{ip}:{port}/'.format(
+        protocol = protocol,
+        ip = args['ip_address'],
+        port = str(args['port'])
+    )
+    # Construct an updated URL if a login and password is supplied
+    if ('login' in args) and ('password' in args):
+        url = '{protocol}://{login}:{password}@{ip}:{port}/'.format(
             protocol = protocol,
+            login = args['login'],
+            password = args['password'],
             ip = args['ip_address'],
             port = str(args['port'])
         )
-        # Construct an updated URL if a login and password is supplied
-        if ('login' in args) and ('password' in args):
-            url = '{protocol}://{login}:{password}@{ip}:{port}/'.format(
-                protocol = protocol,
-                login = args['login'],
-                password = args['password'],
-                ip = args['ip_address'],
-                port = str(args['port'])
-            )
+    return url, url_safe
+
+
+def get_server():
+    """Returns the process-wide couchdb.Server, connecting on first
+    use. Its session keeps a pool of connections to the server.
+    """
+    global _server
+    with _registry_lock:
+        if _server is not None:
+            return _server
+        url, url_safe = _server_urls()
         # Attempt to connect to CouchDB server
         try:
             # Calling couchdb.Server will not throw an exception
-            couch = couchdb.Server(url)
+            couch = couchdb.Server(url, session=couchdb.http.Session())
             # Attempt to GET from the CouchDB server to test connection
             couch.version()
             print("Connected to CouchDB server at " + url_safe)
@@ -74,88 +143,253 @@ class CouchDBComms(DatabaseComms):
                 + str(e)
             )
             raise
+        _server = couch
+        return _server
+
+
+def get_database(db_str):
+    """Returns the process-wide couchdb.Database of a database, creating
+    the database if it doesn't exist.
+    """
+    with _registry_lock:
+        if db_str in _databases:
+            return _databases[db_str]
+        couch = get_server()
         # Attempt to connect to CouchDB database
         try:
-            self._db = couch[self.db_str]
-            print ("Connected to database: " + self.db_str)
+            db = couch[db_str]
+            print ("Connected to database: " + db_str)
         # The python-couchdb docs says that a PreconditionFailed
         # exception is raised when a DB isn't found. But in practice it
         # throws a ResourceNotFound exception (CouchDB == 1.0.1)
         except couchdb.http.ResourceNotFound:
-            try:
-                self._db = couch.create(self.db_str)
-                print ("Creating new database: " + self.db_str)
-            except couchdb.http.Unauthorized:
-                raise
-            except Exception as e:
-                raise
-        except couchdb.http.Unauthorized:
-            raise
-        except Exception as e:
-            raise
-        # Update the design document
-        self.update_views()
+            db = couch.create(db_str)
+            print ("Creating new database: " + db_str)
+        _databases[db_str] = db
+        return db
+
+
+class _Queued:
+    """The response of a store that was added to the write buffer."""
+
+    def __bool__(self):
+        return False
+
+    def __repr__(self):
+        return 'QUEUED'
+
+
+# Returned by CouchDBComms.store_dict() for a buffered doc, which hasn't
+# been written yet. Pass on_stored to find out when it has been.
+QUEUED = _Queued()
+
+
+class DatabaseComms:
+
+    def __init__(self, db_str):
+        """"""
+        self.db_str = db_str
+        self.connect()
+
+    def connect(self):
+        """"""
+
+
+class CouchDBComms(DatabaseComms):
+    """"""
+
+    def __init__(self, db_str, bulk_size=0, bulk_age=30):
+        """
+        Args:
+            db_str (str): The name of the CouchDB database.
+            bulk_size (int): The number of documents to buffer before
+                they are written with a single _bulk_docs request. 0
+                (the default) disables buffering so that every document
+                is saved as soon as it is stored.
+            bulk_age (int/float): The number of seconds the oldest
+                buffered document may wait before the buffer is
+                flushed. None to only flush when the buffer is full.
+        """
+        self.bulk_size = bulk_size
+        self.bulk_age = bulk_age
+        self._buffer = []
+        self._buffer_time = None
+        self._buffer_lock = threading.RLock()
+        self._timer = None
+        # The on_stored callbacks of docs written on another thread,
+        # waiting for the thread that stored them. See _call_back()
+        self._callbacks = []
+        DatabaseComms.__init__(self, db_str)
+        if bulk_size > 0:
+            _live.add(self)
+
+    def connect(self):
+        """Gets the shared connection to the CouchDB server. The
+        database itself is opened on first use, see _db.
+        """
+        self._server = get_server()
+        self._handle = None
+
+    @property
+    def _db(self):
+        """The couchdb.Database, shared with every other CouchDBComms of
+        the same database. Opening it for the first time in the process
+        also updates its design document.
+        """
+        if self._handle is None:
+            with _registry_lock:
+                if self._handle is None:
+                    self._handle = get_database(self.db_str)
+                    if self.db_str not in _synced:
+                        self.update_views()
+                        _synced.add(self.db_str)
+        return self._handle
 
     def create_design_doc(self):
         """Returns a design document. Generates the MapReduce views
-        from JavaScript files stored in the project.
+        from the JavaScript files bundled with the project, see VIEWS.
 
         Returns:
             dict:
         """
-
         view_cat = self.db_str.split('_')[0]
-        _id = '_design/' + view_cat
-
-        # Create a blank new CouchDB design document
-        design_doc = {'_id': _id,
-                      'language': 'javascript',
-                      'views': {}}
-        # Save current working directory
-        cwd = os.getcwd()
-        # Change dir to where the MapReduce .js files are stored
-        dir_path = os.path.dirname(os.path.realpath(__file__))
-        os.chdir(dir_path + '/mapreduce')
-        # Parse the MapReduce .js files
-        for file in os.listdir():
-            if file.endswith('.js'):
-                if (file.split('_', 1)[0] == view_cat):
-                    filename = file.split('_', 1)[1]
-                    filename = os.path.splitext(filename)[0]
-                    view = os.path.splitext(filename)
-                    if design_doc['views'].get(view[0]) is None:
-                        design_doc['views'][view[0]] = {}
-                    if view[1] == '.map':
-                        with open(file) as f:
-                            map = f.read()
-                        design_doc['views'][view[0]]['map'] = map
-                    if view[1] == '.reduce':
-                        with open(file) as f:
-                            reduce = f.read()
-                        design_doc['views'][view[0]]['reduce'] = reduce
-        # Switch back to original current working directory
-        os.chdir(cwd)
-        # Return the design document
-        return design_doc
+        views = VIEWS.get(view_cat, {})
+        return {'_id': '_design/' + view_cat,
+                'language': 'javascript',
+                'views': views,
+                'views_hash': _views_hash(views)}
 
     def update_views(self):
-        """"""
-        # Create a new design document
+        """Saves the bundled views to the design document if they have
+        changed. The stored views_hash is compared rather than the views
+        themselves.
+
+        A new design document is saved straight away and its index is
+        built in the background, see warm_views(). A changed one is
+        staged instead, so that queries don't wait for CouchDB to
+        rebuild the whole index, see stage_views().
+        """
         design_doc = self.create_design_doc()
         # Retrieve the current design document
         current_doc = self._db.get(design_doc['_id'])
-        # Test to see if the design document has changed
-        if current_doc is not None:
-            current_doc = dict(current_doc)
-            test_doc = current_doc.copy()
-            test_doc.pop('_rev', None)
-            if (design_doc == test_doc):
+        if current_doc is None:
+            # Save the design document to CouchDB
+            if self.store_dict(design_doc, buffered=False) is not None:
+                self.warm_views(design_doc)
+            return
+        if current_doc.get('views_hash') == design_doc['views_hash']:
+            return
+        self.stage_views(design_doc, dict(current_doc))
+
+    def stage_views(self, design_doc, current_doc):
+        """Builds the index of a changed design document under a staging
+        design document, then copies it over the live one.
+
+        CouchDB keys an index by the views that define it, so once the
+        staging index is built the live design document takes it over
+        without rebuilding anything. Until then the views that haven't
+        changed are read from the live index, and the ones that have
+        are read from the staging index, see view_name(). The staging
+        design document is kept, so other processes still reading from
+        it don't fail.
+        """
+        staging_doc = dict(design_doc)
+        staging_doc['_id'] = design_doc['_id'] + STAGING_SUFFIX
+        existing = self._db.get(staging_doc['_id'])
+        if existing is not None:
+            staging_doc['_rev'] = existing['_rev']
+        if (existing is None
+                or existing.get('views_hash') != design_doc['views_hash']):
+            if self.store_dict(staging_doc, buffered=False) is None:
                 return
-            design_doc.update({'_rev': current_doc['_rev']})
-        # Save the design document to CouchDB
-        self.store_dict(design_doc)
+        live_views = current_doc.get('views', {})
+        changed = set(
+            view for view in design_doc['views']
+            if live_views.get(view) != design_doc['views'][view]
+        )
+        _staged[self.db_str] = (staging_doc['_id'].split('/', 1)[1],
+                                changed)
+        print(
+            "Rebuilding the views of "
+            + self.db_str
+            + "/"
+            + design_doc['_id']
+            + " in the background: "
+            + ', '.join(sorted(changed))
+        )
 
-    def store_dict(self, doc, overwrite=False):
+        def swap():
+            try:
+                # Wait for the staging index to be built
+                name = (staging_doc['_id'].split('/', 1)[1]
+                        + '/'
+                        + sorted(design_doc['views'])[0])
+                for row in self._db.view(name, wrapper=None, limit=0):
+                    pass
+                design_doc['_rev'] = self._db.get(design_doc['_id'])['_rev']
+                if self.store_dict(design_doc, buffered=False) is not None:
+                    _staged.pop(self.db_str, None)
+                    print(
+                        "Rebuilt the views of "
+                        + self.db_str
+                        + "/"
+                        + design_doc['_id']
+                    )
+            except Exception as e:
+                print(
+                    "Warning: Failed to rebuild the views of "
+                    + self.db_str
+                    + "/"
+                    + design_doc['_id']
+                    + ": "
+                    + str(e)
+                )
+        threading.Thread(target=swap, daemon=True).start()
+
+    def view_name(self, name):
+        """Returns the name to query a view by. A view that is being
+        rebuilt is read from its staging design document, see
+        stage_views().
+
+        Args:
+            name (str): design doc/view, e.g. 'tweets/users_since_id'.
+        """
+        staged = _staged.get(self.db_str)
+        if staged is not None:
+            view = name.split('/', 1)[1]
+            if view in staged[1]:
+                return staged[0] + '/' + view
+        return name
+
+    def warm_views(self, design_doc):
+        """Starts CouchDB building the index of a design document
+        without waiting for it. Every view in a design document shares
+        one index, so querying one view with stale=update_after is
+        enough.
+        """
+        if not design_doc['views']:
+            return
+        name = (design_doc['_id'].split('/', 1)[1]
+                + '/'
+                + sorted(design_doc['views'])[0])
+        def warm():
+            try:
+                for row in self._db.view(name, wrapper=None, limit=0,
+                                         stale='update_after'):
+                    pass
+            except Exception as e:
+                print(
+                    "Warning: Failed to start building the index of "
+                    + self.db_str
+                    + "/"
+                    + design_doc['_id']
+                    + ": "
+                    + str(e)
+                )
+        threading.Thread(target=warm, daemon=True).start()
+
+    def store_dict(self, doc, overwrite=False, buffered=True,
+                   on_stored=None):
         """Stores a dict as a JSON document in CouchDB.
 
         Note: This method does not throw exceptions, it only prints
@@ -166,10 +400,23 @@ class CouchDBComms(DatabaseComms):
             doc (dict): The dict that is to be stored in CouchDB.
             overwrite (bool): True to delete current doc in CouchDB
                 and store the new one. Prevents revisioning.
+            buffered (bool): False to bypass the bulk write buffer and
+                save the doc immediately. Has no effect unless the
+                class was constructed with a bulk_size.
+            on_stored (function): Called with the response once the
+                doc has been written, which for a buffered doc is when
+                the buffer is flushed. Not called if the save fails.
+                It is always called on the thread that stored the doc:
+                if another thread (or the bulk_age timer) flushes the
+                buffer, it is called on the next store or flush made by
+                the storing thread.
 
         Returns:
             dict: If the save is successful this method will return a
                 dict with doc._id (key) and doc._rev (value).
+            QUEUED: If the doc was added to the write buffer. It is
+                falsy, since the doc hasn't been written yet.
+            None: If the save is unsuccessful.
 
         Todo:
             * Need to handle CouchDB connection failure properly. Only
@@ -187,31 +434,24 @@ class CouchDBComms(DatabaseComms):
                 + " is not a dict."
             )
             return None
+        self._call_back()
+        # Add the document to the write buffer if we are in bulk mode
+        if buffered is True and self.bulk_size > 0:
+            return self._buffer_dict(doc, overwrite, on_stored)
+        response = self._save(doc, overwrite)
+        if response is not None and on_stored is not None:
+            on_stored(response)
+        return response
+
+    def _save(self, doc, overwrite):
+        """Saves a doc straight away. See store_dict()."""
         # Attempt to save document to CouchDB
         try:
             response = self._db.save(doc)
             return response
         # If the _id already exists
         except couchdb.http.ResourceConflict as e:
-            print(
-                "Warning: The doc (_id: "
-                + doc['_id']
-                + ") is already in "
-                + self.db_str
-            )
-            if overwrite is True:
-                print(
-                    "Overwriting doc (_id: "
-                    + doc['_id']
-                    + ") in "
-                    + self.db_str
-                )
-                # Delete the document from the database
-                for r in self._db.revisions(doc['_id']):
-                    self._db.purge([{'_id': doc['_id'], '_rev': r.rev}])
-                response = self.store_dict(doc, overwrite=False)
-                return response
-            pass
+            return self._resolve_conflict(doc, overwrite)
         # If the PUT request returns HTTP 404
         except couchdb.http.ResourceNotFound:
             print(
@@ -237,7 +477,183 @@ class CouchDBComms(DatabaseComms):
         # Return None if we encountered an Exception
         return None
 
-    def store_tweet(self, tweet, overwrite=False):
+    def _resolve_conflict(self, doc, overwrite):
+        """Warns that a doc is already in the database and, if
+        overwrite is True, purges the stored doc and saves the new one.
+
+        Returns:
+            dict: The response of the overwriting save.
+            None: If the doc was not overwritten.
+        """
+        print(
+            "Warning: The doc (_id: "
+            + doc['_id']
+            + ") is already in "
+            + self.db_str
+        )
+        if overwrite is True:
+            print(
+                "Overwriting doc (_id: "
+                + doc['_id']
+                + ") in "
+                + self.db_str
+            )
+            # Delete the document from the database
+            for r in self._db.revisions(doc['_id']):
+                self._db.purge([{'_id': doc['_id'], '_rev': r.rev}])
+            response = self.store_dict(doc, overwrite=False, buffered=False)
+            return response
+        return None
+
+    def _buffer_dict(self, doc, overwrite, on_stored=None):
+        """Adds a doc to the write buffer and flushes the buffer if it
+        has reached bulk_size documents. A timer flushes it once its
+        oldest document is bulk_age seconds old.
+
+        A shallow copy of the doc is buffered, since the bulk write
+        adds the _rev to it and the same dict may be buffered for
+        another database too.
+        """
+        if on_stored is not None:
+            on_stored = (threading.get_ident(), on_stored)
+        with self._buffer_lock:
+            if not self._buffer:
+                self._buffer_time = time.time()
+                self._start_timer()
+            self._buffer.append((dict(doc), overwrite, on_stored))
+            full = len(self._buffer) >= self.bulk_size
+        if full:
+            self.flush()
+        return QUEUED
+
+    def _start_timer(self):
+        """Schedules a flush for when the oldest buffered doc is
+        bulk_age seconds old.
+        """
+        if self.bulk_age is None:
+            return
+        self._cancel_timer()
+        self._timer = threading.Timer(self.bulk_age, self._flush_stale)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _flush_stale(self):
+        try:
+            self.flush()
+        except Exception as e:
+            print(
+                "Warning: Failed to flush the write buffer of "
+                + self.db_str
+                + ": "
+                + str(e)
+            )
+
+    def flush(self):
+        """Writes every buffered doc to CouchDB with a single
+        _bulk_docs request.
+
+        Conflicts are reported per document in the same way as
+        store_dict(). If the bulk request itself fails, each doc is
+        saved individually instead. The on_stored callback of each doc
+        that was written is called once the buffer has been written,
+        or later if the doc was stored by another thread, see
+        store_dict().
+
+        Returns:
+            list: A response for each buffered doc, either a tuple of
+                doc._id and doc._rev or None if the save failed.
+        """
+        return self._flush()
+
+    def _flush(self, docs=(), overwrite=False):
+        """Writes the buffer followed by docs. See flush()."""
+        with self._buffer_lock:
+            buffer = self._buffer
+            buffer.extend((doc, overwrite, None) for doc in docs)
+            self._buffer = []
+            self._buffer_time = None
+            self._cancel_timer()
+            if not buffer:
+                responses = []
+            else:
+                responses = self._write(buffer)
+            for (doc, overwrite, on_stored), response in zip(buffer,
+                                                             responses):
+                if response is not None and on_stored is not None:
+                    self._callbacks.append(on_stored + (response,))
+        self._call_back()
+        return responses
+
+    def _call_back(self):
+        """Calls the on_stored callbacks of the docs this thread stored
+        that have been written. They are called outside of the lock, so
+        that a callback that blocks can't hold up other threads storing
+        docs.
+        """
+        thread = threading.get_ident()
+        with self._buffer_lock:
+            if not self._callbacks:
+                return
+            ready = [c for c in self._callbacks if c[0] == thread]
+            self._callbacks = [c for c in self._callbacks
+                               if c[0] != thread]
+        for thread, on_stored, response in ready:
+            on_stored(response)
+
+    def _write(self, buffer):
+        """Writes buffered docs. See flush()."""
+        docs = [doc for doc, overwrite, on_stored in buffer]
+        # Attempt to save all of the documents in one request
+        try:
+            results = self._db.update(docs)
+        except Exception as e:
+            print(
+                "Warning: Attempted to bulk save "
+                + str(len(docs))
+                + " docs to "
+                + self.db_str
+                + ", but we encountered an unexpected Exception: "
+                + str(e)
+                + ". Saving them one at a time."
+            )
+            return [
+                self._save(doc, overwrite)
+                for doc, overwrite, on_stored in buffer
+            ]
+        responses = []
+        for (doc, overwrite, on_stored), (success, _id, result) in zip(
+                buffer, results):
+            if success is True:
+                responses.append((_id, result))
+            # If the _id already exists
+            elif isinstance(result, couchdb.http.ResourceConflict):
+                responses.append(self._resolve_conflict(doc, overwrite))
+            else:
+                print(
+                    "Warning: Attempted to save doc (_id: "
+                    + str(_id)
+                    + ") to database, but we encountered an "
+                    + "unexpected Exception: "
+                    + str(result)
+                )
+                responses.append(None)
+        return responses
+
+    def store_dicts(self, docs, overwrite=False):
+        """Stores several dicts with a single _bulk_docs request,
+        along with anything already in the write buffer. See flush().
+
+        Returns:
+            list: A response for each doc written, see flush().
+        """
+        return self._flush(docs, overwrite)
+
+    def store_tweet(self, tweet, overwrite=False, on_stored=None):
         """This method takes a tweet as an input and stores it in the
         database.
 
@@ -248,15 +664,15 @@ class CouchDBComms(DatabaseComms):
         Args:
             tweet (dict): The tweet that is to be stored in the
                 database. The dict should contain an id_str.
+            on_stored (function): See store_dict().
 
         Returns:
             dict: If the save is successful this method will return a
                 dict with the doc._id (key) and doc._rev (value).
+            QUEUED: If the tweet was buffered, see store_dict().
             None: If the save is unsuccessful.
 
         Todo:
-            * This method could take multiple tweets as inputs and
-                perform a CouchDB bulk insert.
             * This method could take an optional 'force' parameter to
                 flag a revision update.
         """
@@ -276,10 +692,10 @@ class CouchDBComms(DatabaseComms):
             )
             return None
         # Attempt to store the dict in CouchDB
-        response = self.store_dict(tweet, overwrite)
+        response = self.store_dict(tweet, overwrite, on_stored=on_stored)
         return response
 
-    def store_article(self, article):
+    def store_article(self, article, on_stored=None):
         """This method takes an article as an input and stores it in
         the database.
 
@@ -290,15 +706,15 @@ class CouchDBComms(DatabaseComms):
         Args:
             article (dict): The article that is to be stored in the
                 database. The dict should contain a url.
+            on_stored (function): See store_dict().
 
         Returns:
             dict: If the save is successful this method will return a
                 dict with the doc._id (key) and doc._rev (value).
+            QUEUED: If the article was buffered, see store_dict().
             None: If the save is unsuccessful.
 
         Todo:
-            * This method could take multiple articles as inputs and
-                perform a CouchDB bulk insert.
             * This method could take an optional 'force' parameter to
                 flag a revision update.
         """
@@ -318,7 +734,7 @@ class CouchDBComms(DatabaseComms):
             )
             return None
         # Attempt to store the dict in CouchDB
-        response = self.store_dict(article)
+        response = self.store_dict(article, on_stored=on_stored)
         return response
 
     def get_users(self):
@@ -327,7 +743,8 @@ class CouchDBComms(DatabaseComms):
         """
         queue = {}
         try:
-            for row in self._db.view('outlets/users', wrapper=None):
+            for row in self._db.view(self.view_name('outlets/users'),
+                                     wrapper=None):
                 if row.key is not None:
                     queue.update({row.key: row.value})
         except Exception as e:
@@ -340,31 +757,47 @@ class CouchDBComms(DatabaseComms):
     def get_since_ids(self):
         """Returns a dict of Twitter user IDs as keys and the most
         recent tweet from that ID in the database as the values.
+
+        The tweets/users_since_id view reduces the tweet IDs with
+        _stats, so one grouped query returns every user's maximum. The
+        maximum is a double, which can't hold a tweet ID exactly, so
+        SINCE_ID_MARGIN is taken off it. The since_id is then never
+        past the user's most recent tweet, but the timeline returns
+        that tweet, and any others within the margin of it, again.
+        TweetHarvester.store_tweets() looks them up and drops them
+        before they are analysed.
         """
         queue = {}
         try:
-            for row in self._db.view('tweets/users_since_id',
-                                     wrapper=None,
-                                     group='true'):
-                queue.update({row.key: row.value})
+            for row in self._db.view(
+                self.view_name('tweets/users_since_id'),
+                wrapper=None,
+                group_level=1
+            ):
+                since_id = int(row.value['max']) - SINCE_ID_MARGIN
+                queue.update({row.key: str(max(since_id, 0))})
         except:
             raise Exception("Failed to retrieve view: "
                    + self._db.name
-                   + "/tweets/_view/users_since_id?group=true")
+                   + "/tweets/_view/users_since_id?group_level=1")
         return queue
 
     def get_replies_full(self):
         """Retrieves a list of reply-to's that need to be
         downloaded.
+
+        tweets/replies_full emits 0 for each tweet and 1 for each reply
+        to a tweet. A tweet needs downloading when the minimum of its
+        group is 1, i.e. only replies to it are in the database.
         """
         queue = {}
         try:
-            for row in self._db.view('tweets/replies_full',
+            for row in self._db.view(self.view_name('tweets/replies_full'),
                                      wrapper=None,
                                      group_level=1):
-                if (row.value == 1):
+                if (row.value['min'] == 1):
                     queue.update({row.key[0]: {}})
-            for row in self._db.view('tweets/replies_full',
+            for row in self._db.view(self.view_name('tweets/replies_full'),
                                      wrapper=None,
                                      group='true'):
                 if row.key[0] in queue:
@@ -380,7 +813,7 @@ class CouchDBComms(DatabaseComms):
         """Returns XML sitemaps and RSS feeds to be crawled."""
         crawler = {}
         try:
-            for row in self._db.view('outlets/crawler',
+            for row in self._db.view(self.view_name('outlets/crawler'),
                                      wrapper=None):
                 crawler.update({row.key: row.value})
         except:
@@ -389,11 +822,109 @@ class CouchDBComms(DatabaseComms):
                 + "/outlets/_view/crawler\n\n")
         return crawler
 
+    def get_feed_states(self):
+        """Returns a dict of feed URLs and their crawl state docs from
+        the crawler database.
+        """
+        states = {}
+        try:
+            for row in self._db.iterview(
+                '_all_docs',
+                batch=1000,
+                wrapper=None,
+                include_docs=True
+            ):
+                if not row.id.startswith('_design/'):
+                    states[row.id] = dict(row.doc)
+        except:
+            raise Exception("Failed to retrieve view: "
+                + self._db.name
+                + "/_all_docs\n\n")
+        return states
+
+    def store_feed_state(self, state):
+        """Stores the crawl state of a feed. The doc is updated in
+        place with its new _rev once it has been written, so the same
+        dict can be stored again next time.
+
+        Args:
+            state (dict): The crawl state. Its _id is the feed URL.
+
+        Returns:
+            dict: See store_dict().
+        """
+        if '_id' not in state:
+            print(
+                "Warning: store_feed_state() called, but state input "
+                + "parameter does not contain an _id."
+            )
+            return None
+        return self.store_dict(
+            state,
+            on_stored=lambda response: state.update({'_rev': response[1]})
+        )
+
+    def get_revs(self, ids):
+        """Returns the _rev of each of a list of docs that exist in the
+        database, with a single _all_docs request.
+
+        Args:
+            ids (list): The _ids to look up.
+
+        Returns:
+            dict: _ids (keys) and _revs (values). Docs that don't exist
+                or were deleted are left out.
+        """
+        revs = {}
+        if not ids:
+            return revs
+        try:
+            for row in self._db.view('_all_docs', wrapper=None,
+                                     keys=list(ids)):
+                if 'error' in row or row['value'].get('deleted'):
+                    continue
+                revs[row['id']] = row['value']['rev']
+        except:
+            raise Exception("Failed to retrieve view: "
+                + self._db.name
+                + "/_all_docs\n\n")
+        return revs
+
+    def delete_docs(self, revs):
+        """Deletes docs with a single _bulk_docs request.
+
+        Args:
+            revs (dict): The _ids (keys) and _revs (values) of the
+                docs, see get_revs().
+
+        Returns:
+            list: See store_dicts().
+        """
+        return self.store_dicts([
+            {'_id': _id, '_rev': rev, '_deleted': True}
+            for _id, rev in revs.items()
+        ])
+
+    def get_local(self, name):
+        """Returns a _local doc, which is never replicated and isn't
+        listed in _all_docs, or None if it doesn't exist.
+        """
+        try:
+            return self._db.resource('_local', name).get_json()[2]
+        except couchdb.http.ResourceNotFound:
+            return None
+
+    def store_local(self, name, doc):
+        """Stores a _local doc, see get_local(). Pass the doc returned
+        by get_local() to update it.
+        """
+        return self._db.resource('_local', name).put_json(body=doc)[2]
+
     def get_retweets(self):
         retweets = {}
         try:
             for row in self._db.iterview(
-                'tweets/outlet_retweets',
+                self.view_name('tweets/outlet_retweets'),
                 batch=1000,
                 wrapper=None
             ):
@@ -404,6 +935,73 @@ class CouchDBComms(DatabaseComms):
                 + "/tweets/_view/outlet_retweets\n\n")
         return retweets
 
+    def get_update_seq(self):
+        """Returns the database's current update sequence, to be passed
+        to get_changes().
+        """
+        return self._db.info()['update_seq']
+
+    def iter_ids(self, batch=10000):
+        """Yields the _id of every document in the database, except for
+        design documents.
+        """
+        try:
+            for row in self._db.iterview('_all_docs', batch=batch,
+                                         wrapper=None):
+                if not row.id.startswith('_design/'):
+                    yield row.id
+        except Exception:
+            raise Exception("Failed to retrieve view: "
+                + self._db.name
+                + "/_all_docs\n\n")
+
+    def iter_docs(self, startkey=None, batch=1000):
+        """Yields every document in the database in _id order, except
+        for design documents.
+
+        Args:
+            startkey (str): Start from this _id (inclusive).
+            batch (int): The number of documents requested at a time.
+        """
+        options = {}
+        if startkey is not None:
+            options['startkey'] = startkey
+        try:
+            for row in self._db.iterview('_all_docs', batch=batch,
+                                         wrapper=None, include_docs=True,
+                                         **options):
+                if not row.id.startswith('_design/'):
+                    yield dict(row.doc)
+        except Exception:
+            raise Exception("Failed to retrieve view: "
+                + self._db.name
+                + "/_all_docs\n\n")
+
+    def get_changes(self, since, limit=10000):
+        """Returns the documents changed since an update sequence.
+
+        Args:
+            since: An update sequence from get_update_seq() or a
+                previous call.
+            limit (int): The maximum number of changes to return.
+
+        Returns:
+            tuple: A list of (doc._id, deleted) tuples and the update
+                sequence to pass as since next time.
+        """
+        try:
+            data = self._db.changes(since=since, limit=limit)
+        except:
+            raise Exception("Failed to retrieve changes feed: "
+                + self._db.name
+                + "/_changes\n\n")
+        changes = [
+            (row['id'], row.get('deleted', False))
+            for row in data['results']
+            if not row['id'].startswith('_design/')
+        ]
+        return changes, data['last_seq']
+
     def get_articles_list(self, timerange='0'):
         """Returns a dict of article URLs currently in the database and
         the revision numbers.
@@ -411,7 +1009,7 @@ class CouchDBComms(DatabaseComms):
         articles = []
         try:
             for row in self._db.iterview(
-                'articles/opengraph',
+                self.view_name('articles/opengraph'),
                 batch=1000,
                 wrapper=None,
                 descending='true',
@@ -442,7 +1040,7 @@ class CouchDBComms(DatabaseComms):
     def get_opengraph(self, timerange='0'):
         articles = []
         try:
-            for row in self._db.view('articles/opengraph',
+            for row in self._db.view(self.view_name('articles/opengraph'),
                                      wrapper=None,
                                      descending='true',
                                      endkey=timerange
@@ -458,7 +1056,7 @@ class CouchDBComms(DatabaseComms):
         topics = {}
         try:
             for row in self._db.view(
-                'tweets/topics',
+                self.view_name('tweets/topics'),
                 wrapper=None,
                 group=True
             ):
@@ -471,20 +1069,45 @@ class CouchDBComms(DatabaseComms):
                 sorted_topics.append({t: topics[t]})
         return sorted_topics
 
-    def get_topic_tweets(self, topic):
-        map_fun = '''function(doc) {
-          for (var i = 0; i < doc.features.length; i++) {
-            if (doc.features[i] == "''' + topic + '''") {
-              emit(doc.features[i], doc);
-            }
-          }
-        }'''
-        tweets = []
-        for row in self._db.query(map_fun, reduce_fun=None,
-            language='javascript', wrapper=None):
-            tweets.append(row.value)
-        sorted_tweets = sorted(tweets, key=lambda k: k['wa']['time'], reverse=True)
-        return sorted_tweets
+    def iter_topic_tweets(self, topic, limit=None, batch=1000):
+        """Yields the tweets with a topic, newest first.
+
+        Reads the tweets/topic_time view, keyed by [feature, wa.time],
+        a page at a time with the tweets included.
+
+        Args:
+            topic (str): The feature.
+            limit (int): The maximum number of tweets to yield, at
+                least 1. None (the default) yields every tweet.
+            batch (int): The number of tweets requested at a time.
+        """
+        options = {}
+        if limit is not None:
+            if limit < 1:
+                raise ValueError("limit must be 1 or more")
+            options['limit'] = limit
+        try:
+            for row in self._db.iterview(self.view_name('tweets/topic_time'),
+                                         batch=batch,
+                                         wrapper=None,
+                                         include_docs=True,
+                                         descending=True,
+                                         startkey=[topic, {}],
+                                         endkey=[topic],
+                                         **options):
+                yield dict(row.doc)
+        # Not a bare except, which would turn the GeneratorExit raised
+        # when the caller stops early into a view failure
+        except Exception:
+            raise Exception("Failed to retrieve view: "
+                + self._db.name
+                + "/tweets/_view/topic_time\n\n")
+
+    def get_topic_tweets(self, topic, limit=None):
+        """Returns a list of the tweets with a topic, newest first. See
+        iter_topic_tweets().
+        """
+        return list(self.iter_topic_tweets(topic, limit=limit))
 
     def shard_tweets(self, timerange='0'):
         """This should basically work like this:
@@ -0,0 +1,7 @@
+function(doc) {
+  if (doc.features != null && doc.wa != null && doc.wa.time != null) {
+    for (var i = 0; i < doc.features.length; i++) {
+      emit([doc.features[i], Number(doc.wa.time)], null);
+    }
+  }
+}
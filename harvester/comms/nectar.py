@@ -6,22 +6,137 @@ Classes used to programmatically use the NeCTAR Research Cloud.
 boto.s3 docs: http://boto.cloudhackers.com/en/latest/ref/s3.html
 """
 
-import requests
+import os
+import time
+import base64
+import hashlib
+import sqlite3
+import tempfile
+import threading
 
 import boto.s3.connection
 from boto.s3.key import Key
 
 import core
+from comms import web
+
+# Downloads are read in chunks of this many bytes
+CHUNK_SIZE = 64 * 1024
+# Downloads are held in memory up to this size, then spill to disk
+SPOOL_SIZE = 8 * 1024 * 1024
+# Objects of at least this size are uploaded in parts of PART_SIZE
+MULTIPART_THRESHOLD = 32 * 1024 * 1024
+PART_SIZE = 16 * 1024 * 1024
+
+
+class MediaIndex():
+    """A local SQLite index of the media stored in the Object Store.
+
+    Maps each source URL to the MD5 of its content, which is also the
+    name of the object it was stored as. The index is kept in a file
+    so that it survives restarts.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): The SQLite database file. Created if it doesn't
+                exist.
+        """
+        self.path = path
+        # The connection is shared by every thread that stores media
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS media ('
+                'bucket TEXT NOT NULL, '
+                'url TEXT NOT NULL, '
+                'md5 TEXT NOT NULL, '
+                'time INTEGER NOT NULL, '
+                'PRIMARY KEY (bucket, url))'
+            )
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS media_md5 ON media (bucket, md5)'
+            )
+
+    def get_md5(self, bucket, url):
+        """Returns the MD5 of the content last stored from a URL, or
+        None.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT md5 FROM media WHERE bucket = ? AND url = ?',
+                (bucket, url)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def has_md5(self, bucket, md5):
+        """Returns True if content with this MD5 has been stored."""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT 1 FROM media WHERE bucket = ? AND md5 = ? LIMIT 1',
+                (bucket, md5)
+            ).fetchone()
+        return row is not None
+
+    def add(self, bucket, url, md5):
+        """Records that the content of a URL is stored as md5."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?)',
+                (bucket, url, md5, int(time.time()))
+            )
+
+    def forget(self, bucket, md5):
+        """Removes every URL stored as md5, e.g. once the object is
+        found to be missing from the bucket.
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                'DELETE FROM media WHERE bucket = ? AND md5 = ?',
+                (bucket, md5)
+            )
 
 
 class ObjectStore():
 
-    def __init__(self, bucket_name):
-        """"""
+    def __init__(self, bucket_name, index_path=None):
+        """
+        Args:
+            bucket_name (str): The bucket to store objects in.
+            index_path (str): The MediaIndex file. Defaults to the
+                'media_index' setting in the nectar section of
+                config.yaml, or media_index.sqlite in the project's
+                base dir.
+        """
         args = core.config('nectar')
         self.bucket_name = bucket_name
+        # boto connections aren't thread-safe, so each thread that
+        # stores objects opens its own. See bucket
+        self._local = threading.local()
+        self._connect()
+        # Save the URL for public access
+        self.public_url = args['s3']['public_url']
+        # Open the index of media we have already stored
+        if index_path is None:
+            index_path = args.get('media_index')
+        if index_path is None:
+            base_dir = os.path.dirname(
+                os.path.dirname(os.path.realpath(core.__file__))
+            )
+            index_path = os.path.join(base_dir, 'media_index.sqlite')
+        self.index = MediaIndex(index_path)
+        # Objects confirmed to be in the bucket by this process
+        self._verified = set()
+
+    def _connect(self):
+        """Opens this thread's connection to the Object Store and its
+        bucket.
+        """
+        args = core.config('nectar')
         try:
-            self.connection = boto.s3.connection.S3Connection(
+            self._local.connection = boto.s3.connection.S3Connection(
                 aws_access_key_id=args['ec2_access_key'],
                 aws_secret_access_key=args['ec2_secret_key'],
                 port=int(args['s3']['port']),
@@ -35,35 +150,156 @@ class ObjectStore():
         # Open the bucket
         try:
             # get_bucket() requires validate=False to work with python3
-            self.bucket = self.connection.get_bucket(
+            self._local.bucket = self._local.connection.get_bucket(
                 self.bucket_name,
                 validate=False
             )
         except:
             raise
-        # Save the URL for public access
-        self.public_url = args['s3']['public_url']
+
+    @property
+    def connection(self):
+        """This thread's boto S3Connection."""
+        if not hasattr(self._local, 'connection'):
+            self._connect()
+        return self._local.connection
+
+    @property
+    def bucket(self):
+        """The bucket, opened on this thread's connection."""
+        if not hasattr(self._local, 'bucket'):
+            self._connect()
+        return self._local.bucket
+
+    def object_url(self, md5):
+        """Returns the public URL of the object stored as md5."""
+        return '{public_url}{bucket}/{etag}'.format(
+            public_url = self.public_url,
+            bucket = self.bucket_name,
+            etag = md5
+        )
+
+    def exists(self, md5):
+        """Returns True if the object stored as md5 is in the bucket.
+        Sends a HEAD request the first time each object is checked.
+        """
+        if md5 in self._verified:
+            return True
+        if self.bucket.get_key(md5) is None:
+            return False
+        self._verified.add(md5)
+        return True
 
     def store(self, url):
         """Downloads a Web object from a specified URL and stores it in
         the NeCTAR Object Store. Returns the URL of the archived
         object.
+
+        Objects are named by the MD5 of their content. A URL that has
+        been stored before isn't downloaded again, and content that is
+        already in the bucket isn't uploaded again.
+
+        The download is streamed into a spooled temporary file, which
+        only stays in memory while it is smaller than SPOOL_SIZE, and
+        large objects are uploaded in parts, so memory use is bounded
+        however large the object is.
         """
+        # Skip the download if we have stored this URL before and the
+        # object is still in the bucket
+        md5 = self.index.get_md5(self.bucket_name, url)
+        if md5 is not None:
+            if self.exists(md5):
+                return self.object_url(md5)
+            self.index.forget(self.bucket_name, md5)
         try:
-            response = requests.get(url)
-            k = Key(self.bucket)
-            k.set_contents_from_string(
-                response.content,
-                headers=response.headers
-            )
-            # Remove the double quotation marks from the k.etag string
-            etag = k.etag[1:-1]
-            # Return the URL of where the object should be stored
-            object_url = '{public_url}{bucket}/{etag}'.format(
-                public_url = self.public_url,
-                bucket = self.bucket_name,
-                etag = etag
+            response = web.get(url, stream=True)
+            # The session returns error pages once its retries run out.
+            # Never archive one in place of the object.
+            if not 200 <= response.status_code < 300:
+                response.close()
+                raise Exception(
+                    "Invalid response from the URL ("
+                    + url
+                    + ").\nHTTP status code: "
+                    + str(response.status_code)
+                    + "."
+                )
+            headers = {}
+            if 'Content-Type' in response.headers:
+                headers['Content-Type'] = response.headers['Content-Type']
+            with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as f:
+                # Hash the content as it is downloaded
+                hasher = hashlib.md5()
+                size = 0
+                try:
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        f.write(chunk)
+                        hasher.update(chunk)
+                        size += len(chunk)
+                finally:
+                    response.close()
+                digest = hasher.digest()
+                md5 = digest.hex()
+                # Skip the upload if the same content is already
+                # stored, e.g. a logo used on every article
+                if not (self.index.has_md5(self.bucket_name, md5)
+                        and self.exists(md5)):
+                    self._upload(f, size, digest, headers)
+                    self._verified.add(md5)
+            self.index.add(self.bucket_name, url, md5)
+            # Return the URL of where the object is stored
+            return self.object_url(md5)
+        except:
+            raise
+
+    def store_content(self, content, headers=None):
+        """Stores bytes in the NeCTAR Object Store, named by their MD5
+        like store(), and returns the URL of the object. Content that
+        is already in the bucket isn't uploaded again.
+
+        Args:
+            content (bytes):
+            headers (dict): Headers stored with the object, e.g.
+                Content-Type.
+
+        Returns:
+            str:
+        """
+        digest = hashlib.md5(content).digest()
+        md5 = digest.hex()
+        if not self.exists(md5):
+            with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as f:
+                f.write(content)
+                self._upload(f, len(content), digest, headers or {})
+            self._verified.add(md5)
+        return self.object_url(md5)
+
+    def _upload(self, f, size, digest, headers):
+        """Uploads a file as the object named by its MD5 digest, in
+        parts if it is at least MULTIPART_THRESHOLD bytes.
+        """
+        md5 = digest.hex()
+        if size < MULTIPART_THRESHOLD:
+            f.seek(0)
+            k = Key(self.bucket, md5)
+            k.set_contents_from_file(
+                f,
+                headers=headers,
+                md5=(md5, base64.b64encode(digest).decode('ascii')),
+                size=size
             )
-            return object_url
+            return
+        mp = self.bucket.initiate_multipart_upload(md5, headers=headers)
+        try:
+            for part_num, offset in enumerate(range(0, size, PART_SIZE), 1):
+                f.seek(offset)
+                mp.upload_part_from_file(
+                    f,
+                    part_num,
+                    size=min(PART_SIZE, size - offset)
+                )
+            mp.complete_upload()
         except:
+            # Don't leave the uploaded parts in the bucket
+            mp.cancel_upload()
             raise
@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+"""comms.web
+
+A shared HTTP session for every outbound fetch made by the harvester.
+
+The session keeps connections alive in a pool per host, retries failed
+requests with a backoff and applies a default timeout. Settings can be
+overridden in the optional 'http' section of config.yaml:
+
+http:
+  timeout: 30
+  retries: 3
+  backoff_factor: 0.5
+  pool_connections: 20
+  pool_maxsize: 20
+  user_agent: optional
+"""
+
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+import core
+
+# brotli is optional. urllib3 decodes br responses when it's installed.
+try:
+    import brotli
+    ACCEPT_ENCODING = 'gzip, deflate, br'
+except ImportError:
+    ACCEPT_ENCODING = 'gzip, deflate'
+
+DEFAULTS = {
+    'timeout': 30,
+    'retries': 3,
+    'backoff_factor': 0.5,
+    'pool_connections': 20,
+    'pool_maxsize': 20,
+    'user_agent': None
+}
+
+_session = None
+_settings = None
+_lock = threading.Lock()
+
+
+def settings():
+    """Returns the HTTP settings, DEFAULTS updated with the 'http'
+    section of config.yaml.
+    """
+    global _settings
+    if _settings is None:
+        args = dict(DEFAULTS)
+        args.update(core.config().get('http', {}))
+        _settings = args
+    return _settings
+
+
+def get_session():
+    """Returns the process-wide requests.Session, creating it on first
+    use.
+    """
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = _create_session()
+    return _session
+
+
+def _create_session():
+    args = settings()
+    # Retry connection errors and server errors with an exponential
+    # backoff. Responses are still returned once the retries run out
+    # so that callers can inspect the status code.
+    retry = Retry(
+        total=int(args['retries']),
+        backoff_factor=float(args['backoff_factor']),
+        status_forcelist=(500, 502, 503, 504),
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(
+        pool_connections=int(args['pool_connections']),
+        pool_maxsize=int(args['pool_maxsize']),
+        max_retries=retry
+    )
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+    if args['user_agent'] is not None:
+        session.headers['User-Agent'] = args['user_agent']
+    return session
+
+
+def get(url, **kwargs):
+    """Sends a GET request through the shared session. Takes the same
+    arguments as requests.get().
+
+    Returns:
+        requests.models.Response:
+    """
+    kwargs.setdefault('timeout', float(settings()['timeout']))
+    return get_session().get(url, **kwargs)
+
+
+def head(url, **kwargs):
+    """Sends a HEAD request through the shared session. Takes the same
+    arguments as requests.head().
+
+    Returns:
+        requests.models.Response:
+    """
+    kwargs.setdefault('timeout', float(settings()['timeout']))
+    return get_session().head(url, **kwargs)
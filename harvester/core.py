@@ -4,38 +4,43 @@
 import os
 import sys
 import yaml
+import signal
 import argparse
+import threading
+from types import MappingProxyType
 from datetime import datetime
 import dateutil.parser
 
-def config(*subconfig):
-    """Returns a dict that contains all of the settings.
+# The process-wide settings. Loaded on the first call to config()
+_settings = None
+_settings_lock = threading.Lock()
 
-    The settings are a combination of data in config.yaml and valid
-    command line arguments.
 
-    Args:
-        *subconfig (str): Pass strings to return specific subsets of
-            the config.
+def _freeze(value):
+    """Returns a read-only copy of a parsed settings value. dicts
+    become MappingProxyType objects and lists become tuples.
+    """
+    if isinstance(value, dict):
+        return MappingProxyType(
+            {k: _freeze(v) for k, v in value.items()}
+        )
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
 
-    Returns:
-        dict: Software settings (config.yaml and command line args).
 
-    Raises:
+def _load_settings():
+    """Reads config.yaml and the command line arguments.
 
+    Returns:
+        MappingProxyType: Read-only software settings.
     """
-
-    # Save current working dir
-    cwd = os.getcwd()
-    # Change working dir to the projects base dir
+    # config.yaml is stored in the projects base dir
     current_dir = os.path.dirname(os.path.realpath(__file__))
     target_dir = os.path.dirname(current_dir)
-    os.chdir(target_dir)
     # Parse config.yaml
-    with open('config.yaml', 'r') as stream:
+    with open(os.path.join(target_dir, 'config.yaml'), 'r') as stream:
         args = yaml.load(stream)
-    # Change working dir back to original dir
-    os.chdir(cwd)
 
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='')
@@ -49,11 +54,60 @@ def config(*subconfig):
         '-p',
         help='The total number of processes.'
     )
-    # Store command line arguments in a dict
-    cl_args = parser.parse_args()
+    # Store command line arguments in a dict. Arguments we don't know
+    # are left for the script that is running.
+    cl_args, unknown = parser.parse_known_args()
     cl_args_dict = vars(cl_args)
     # Combine
     args.update(cl_args_dict)
+    return _freeze(args)
+
+
+def reload_config(*args):
+    """Re-reads config.yaml and the command line arguments. Later calls
+    to config() return the new settings.
+
+    Accepts (and ignores) positional arguments so that it can be used
+    as a signal handler.
+    """
+    global _settings
+    settings = _load_settings()
+    with _settings_lock:
+        _settings = settings
+
+
+def install_reload_handler(signum=signal.SIGHUP):
+    """Reloads the settings whenever the process receives signum
+    (SIGHUP by default).
+    """
+    signal.signal(signum, reload_config)
+
+
+def config(*subconfig):
+    """Returns a dict that contains all of the settings.
+
+    The settings are a combination of data in config.yaml and valid
+    command line arguments. They are parsed once per process (see
+    reload_config()) and returned read-only, so every call after the
+    first costs a dict lookup.
+
+    Args:
+        *subconfig (str): Pass strings to return specific subsets of
+            the config.
+
+    Returns:
+        MappingProxyType: Software settings (config.yaml and command
+            line args).
+
+    Raises:
+
+    """
+    global _settings
+    if _settings is None:
+        with _settings_lock:
+            if _settings is None:
+                _settings = _load_settings()
+    args = _settings
     # Find subconfig if argument is passed
     for s in subconfig:
         try:
@@ -63,6 +117,52 @@ def config(*subconfig):
     # Return
     return args
 
+def split_namespace(old_dict):
+    """Takes a dict and if the key has a colon, then create a
+    subdict.
+    """
+    new_dict = {}
+
+    for key in old_dict:
+        # Turn it into a nested dict
+        tmp = old_dict[key]
+        split_key = key.split(':')
+        for s in reversed(split_key):
+            tmp = {s: tmp}
+        # Merge it into the main dict
+        new_dict = merge(new_dict, tmp)
+
+    return new_dict
+
+def merge(a, b, path=None):
+    """merges dict b into a
+    """
+    if path is None:
+        path = []
+    for key in b:
+        if key in a:
+            if isinstance(a[key], dict) and isinstance(b[key], dict):
+                merge(a[key], b[key], path + [str(key)])
+            # If we are inserting a key/value into a key/dict
+            elif isinstance(a[key], dict) and not isinstance(b[key], dict):
+                tmp = b[key]
+                b[key] = {'content': tmp}
+                merge(a[key], b[key], path + [str(key)])
+            # If we are inserting a key/dict into a key/value
+            elif not isinstance(a[key], dict) and isinstance(b[key], dict):
+                tmp = a[key]
+                a[key] = {'content': tmp}
+                merge(a[key], b[key], path + [str(key)])
+            # Same leaf value
+            elif a[key] == b[key]:
+                pass
+            else:
+                #raise Exception('Conflict at %s' % '.'.join(path + [str(key)]))
+                pass
+        else:
+            a[key] = b[key]
+    return a
+
 def get_time(date):
     """A commonly used method to convert ISO 8601 datetimes to UNIX
     timestamps.
@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+"""extract
+
+Extracts the metadata and text of an article from its HTML.
+
+Kept apart from OGHarvester so that stored HTML can be parsed again
+without a database or Object Store connection (see reprocess).
+
+The page is parsed once into an lxml tree. The <meta> tags and <title>
+are found with XPath and the boilerplate elements are stripped in a
+single pass before the text is read. The output is the same as the
+BeautifulSoup implementation this replaced (kept for comparison in
+scripts/bench_parse_article.py).
+"""
+
+import itertools
+
+from lxml import etree
+from bs4.dammit import EncodingDetector
+
+import core
+from media import is_image
+
+# Elements that are not part of an article's text
+NON_TEXT_TAGS = [
+    'head', 'header', 'nav', 'aside', 'footer', 'script', 'noscript',
+    'style', 'meta', 'button', 'source', 'img', 'path', 'svg', 'form',
+    'embed', 'menu', 'iframe'
+]
+
+_META_XPATH = etree.XPath('//meta[@property or @name]')
+_TITLE_XPATH = etree.XPath('(//title)[1]')
+_ARTICLE_XPATH = etree.XPath('(//article)[1]')
+_BODY_XPATH = etree.XPath('(//body)[1]')
+
+
+def _encoding(html):
+    """Returns the encoding BeautifulSoup would have decoded a page
+    with, and the page without a byte order mark.
+
+    A byte order mark wins, then an encoding declared in the document,
+    then UTF-8 if the page is valid UTF-8. Otherwise BeautifulSoup's
+    guesses are used (including chardet, if it is installed).
+    """
+    markup, encoding = EncodingDetector.strip_byte_order_mark(html)
+    if encoding is None:
+        encoding = EncodingDetector.find_declared_encoding(markup,
+                                                           is_html=True)
+    if encoding is None:
+        try:
+            markup.decode('utf-8')
+            encoding = 'utf-8'
+        except UnicodeDecodeError:
+            for encoding in EncodingDetector(markup, is_html=True).encodings:
+                break
+    return markup, encoding
+
+
+def _parse(html):
+    """Parses an HTML document into an lxml tree."""
+    if isinstance(html, bytes):
+        html, encoding = _encoding(html)
+        # If libxml2 doesn't know the encoding, carry on down
+        # BeautifulSoup's list of guesses
+        guesses = EncodingDetector(html, is_html=True,
+                                   exclude_encodings=[encoding]).encodings
+    else:
+        html, encoding, guesses = html.encode('utf-8'), 'utf-8', ()
+    root = None
+    for encoding in itertools.chain([encoding], guesses):
+        try:
+            root = etree.fromstring(html, etree.HTMLParser(encoding=encoding))
+            break
+        except LookupError:
+            continue
+        except etree.XMLSyntaxError:
+            break
+    # An empty document
+    if root is None:
+        root = etree.Element('html')
+    return root
+
+
+def _string(element):
+    """Returns the equivalent of BeautifulSoup's Tag.string: the only
+    string in an element, looking through elements that have a single
+    child. None if there is more (or less) than one string.
+    """
+    while True:
+        children = list(element)
+        if not children:
+            return element.text
+        if element.text or len(children) > 1 or children[0].tail:
+            return None
+        element = children[0]
+        if not isinstance(element.tag, str):
+            # A comment or processing instruction
+            return element.text
+
+
+def parse_html(html, media=None):
+    """Returns the metadata and text of a web page.
+
+    Args:
+        html (bytes/str): The HTML document.
+        media (set): If passed, the image URLs in meta tags are added
+            to it.
+
+    Returns:
+        dict: 'meta', the Open Graph, Twitter and other meta tags and
+            the title, and 'text', the text of the article.
+    """
+    root = _parse(html)
+    # Create an empty dict for the metadata
+    meta = {}
+    # Store Open Graph and Twitter metadata
+    for m in _META_XPATH(root):
+        for attr in ['property', 'name']:
+            key = m.get(attr)
+            if key is not None:
+                # Raises a KeyError if there is no content, as
+                # BeautifulSoup did
+                content = m.attrib['content']
+                meta[key] = content
+                # If the meta value is an image
+                if media is not None and is_image(content):
+                    media.add(content)
+    try:
+        meta = core.split_namespace(meta)
+    except Exception as e:
+        print(str(e))
+    # Store other metadata
+    title = _TITLE_XPATH(root)
+    if title:
+        meta['title'] = _string(title[0])
+    ### Store article content
+    # Try to narrow down the tree
+    tree_small = _ARTICLE_XPATH(root) or _BODY_XPATH(root) or [root]
+    tree_small = tree_small[0]
+    # Remove irrelevant elements, keeping the text that follows them
+    etree.strip_elements(tree_small, *NON_TEXT_TAGS, with_tail=False)
+    # Get string
+    text = ''.join(tree_small.itertext())
+    return {'meta': meta, 'text': clean_text(text)}
+
+
+def clean_text(text):
+    """Strips each line of text, splits lines on double spaces and
+    drops blank lines.
+    """
+    # Break into lines and remove leading and trailing space on each
+    lines = (line.strip() for line in text.splitlines())
+    # Break multi-headlines into a line each
+    chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
+    # Drop blank lines
+    return '\n'.join(chunk for chunk in chunks if chunk)
@@ -0,0 +1,378 @@
+#!/usr/bin/python3
+"""feeds
+
+Streaming parsers for XML sitemaps and RSS feeds.
+
+The document is fed to an lxml pull parser as it is downloaded. Each
+<url> or <item> is converted to a dict as soon as it has been parsed
+and is then cleared from the tree, so memory use stays flat however
+large the sitemap or feed is. The article dicts have the same shape as
+the ones OGHarvester.parse_sitemap() and parse_rss() used to build with
+BeautifulSoup. tag_to_dict() converts either kind of tree.
+"""
+
+import copy
+import time
+
+import bs4
+from lxml import etree
+
+import core
+
+# The prefix BeautifulSoup gives to attributes in the XML namespace
+_XML_NS = 'http://www.w3.org/XML/1998/namespace'
+# Sitemap index files may only list sitemaps, but don't follow
+# indexes of indexes forever
+MAX_SITEMAP_DEPTH = 2
+
+
+def iter_events(chunks):
+    """Feeds chunks of an XML document to a pull parser.
+
+    Args:
+        chunks (iterable): bytes.
+
+    Yields:
+        tuple: (event, element) for each 'start' and 'end' event.
+    """
+    parser = etree.XMLPullParser(events=('start', 'end'), recover=True)
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event in parser.read_events():
+            yield event
+    try:
+        parser.close()
+    except etree.XMLSyntaxError:
+        pass
+    for event in parser.read_events():
+        yield event
+
+
+def _release(element):
+    """Frees an element that has been converted, along with any
+    siblings that came before it.
+    """
+    element.clear()
+    parent = element.getparent()
+    if parent is not None:
+        while element.getprevious() is not None:
+            del parent[0]
+
+
+def _name(element, html):
+    """Returns the (namespace, name) that BeautifulSoup would give an
+    element.
+
+    With html=True the names are the ones BeautifulSoup's HTML parser
+    produced for sitemaps: the prefix stays part of the lower cased
+    name (e.g. 'image:loc') and there is no namespace.
+    """
+    local = etree.QName(element).localname
+    prefix = element.prefix
+    if html:
+        if prefix:
+            local = prefix + ':' + local
+        return 'none', local.lower()
+    return (prefix or 'none'), local
+
+
+def _attributes(element, html):
+    """Returns an element's attributes, named as BeautifulSoup would
+    name them. Namespace declarations made on the element are included
+    as 'xmlns' or 'xmlns:prefix' attributes.
+    """
+    attrs = {}
+    parent = element.getparent()
+    inherited = parent.nsmap if parent is not None else {}
+    for prefix, uri in element.nsmap.items():
+        if inherited.get(prefix) != uri:
+            attrs['xmlns:' + prefix if prefix else 'xmlns'] = uri
+    prefixes = None
+    for key, value in element.attrib.items():
+        if key[0] == '{':
+            if prefixes is None:
+                prefixes = {uri: p for p, uri in element.nsmap.items()}
+                prefixes[_XML_NS] = 'xml'
+            uri, local = key[1:].split('}', 1)
+            prefix = prefixes.get(uri)
+            key = prefix + ':' + local if prefix else local
+        attrs[key] = value
+    if html:
+        attrs = {k.lower(): v for k, v in attrs.items()}
+    return attrs
+
+
+def _string(element):
+    """Returns the equivalent of BeautifulSoup's Tag.string for an
+    element without child elements: its text if it contains exactly
+    one text or comment node, otherwise None.
+    """
+    nodes = []
+    if element.text:
+        nodes.append(element.text)
+    for child in element:
+        nodes.append(child.text)
+        if child.tail:
+            nodes.append(child.tail)
+        if len(nodes) > 1:
+            return None
+    if len(nodes) == 1:
+        return nodes[0]
+    return None
+
+
+def _read_element(element, html):
+    """Returns the (namespace, name, prefix, child elements) of an lxml
+    element, for tag_to_dict().
+    """
+    namespace, name = _name(element, html)
+    children = [c for c in element if isinstance(c.tag, str)]
+    return namespace, name, (None if html else element.prefix), children
+
+
+def _read_element_leaf(element, html):
+    # The contents of an element without child elements
+    attrs = _attributes(element, html)
+    if attrs:
+        attrs['content'] = _string(element)
+        return attrs
+    return _string(element)
+
+
+def _read_tag(tag, html):
+    """Returns the (namespace, name, prefix, child tags) of a
+    BeautifulSoup tag, for tag_to_dict().
+    """
+    if tag.prefix is not None:
+        namespace = tag.prefix
+    else:
+        namespace = 'none'
+    children = [c for c in tag.children if type(c) is bs4.element.Tag]
+    return namespace, tag.name, tag.prefix, children
+
+
+def _read_tag_leaf(tag, html):
+    # The contents of a tag without child tags. The attributes are
+    # copied (keeping BeautifulSoup's attribute dict, which stores None
+    # as '') rather than added to, so the tree is left as it was.
+    if tag.attrs:
+        attrs = copy.copy(tag.attrs)
+        attrs['content'] = tag.string
+        return attrs
+    return tag.string
+
+
+def _add(return_dict, namespace, name, tag_dict):
+    """Stores a converted tag, making a list if there is already a tag
+    with the same name.
+    """
+    tags = return_dict.setdefault(namespace, {})
+    if name in tags:
+        if type(tags[name]) is not list:
+            tags[name] = [tags[name]]
+        tags[name].append(tag_dict)
+    else:
+        tags[name] = tag_dict
+
+
+def tag_to_dict(tag, html=False):
+    """Converts the children of a BeautifulSoup tag or an lxml element
+    to a dict.
+
+    Preserves duplicate tags by creating a list of dicts.
+    Preserves namespaces.
+    Preserves attributes by creating a dict (normally <key>value</key>
+    to be compact, but {'subkey': 'subvalue', 'content': 'value'} for
+    <key subkey="subvalue">value</key> if needed).
+
+    Tags without a namespace are stored in the parent dict, and the
+    namespace of a tag is removed from its own children.
+
+    The tree is walked once with an explicit stack, so the time taken
+    is linear in the number of tags and deeply nested items don't hit
+    the recursion limit.
+
+    Args:
+        tag (bs4.element.Tag/lxml.etree._Element):
+        html (bool): For lxml elements, True to name tags as
+            BeautifulSoup's HTML parser did for sitemaps (see
+            _name()).
+
+    Returns:
+        dict:
+    """
+    if isinstance(tag, etree._Element):
+        read, read_leaf = _read_element, _read_element_leaf
+    else:
+        read, read_leaf = _read_tag, _read_tag_leaf
+    result = {}
+    # Each frame holds the children left to convert, the dict they are
+    # converted into and where that dict goes once they are done
+    stack = [(iter(read(tag, html)[3]), result, None)]
+    while stack:
+        children, return_dict, parent = stack[-1]
+        for child in children:
+            namespace, name, prefix, grandchildren = read(child, html)
+            # If this tag has children tags, convert them first
+            if grandchildren:
+                stack.append((
+                    iter(grandchildren),
+                    {},
+                    (namespace, name, prefix)
+                ))
+                break
+            # Store the tag contents
+            _add(return_dict, namespace, name, read_leaf(child, html))
+        else:
+            stack.pop()
+            # Move 'none' namespace dict into parent dict, if 'none'
+            # exists
+            return_dict.update(return_dict.pop('none', {}))
+            if parent is not None:
+                namespace, name, prefix = parent
+                # Kill any namespaces from child tags
+                if prefix is not None and prefix in return_dict:
+                    return_dict = return_dict[prefix]
+                _add(stack[-1][1], namespace, name, return_dict)
+    return result
+
+
+def iter_feed(chunks, url, fetch=None, depth=0, indexes=None):
+    """Parses an XML sitemap, sitemap index or RSS feed, detecting
+    which one it is from the root element.
+
+    Args:
+        chunks (iterable): The document as bytes, or None if it hasn't
+            changed since it was last read.
+        url (str): The URL of the document.
+        fetch (function): Called with a URL, returns an iterable of
+            bytes, or None if the document hasn't changed. Used to
+            download the sitemaps listed in a sitemap index. Sitemap
+            indexes are skipped if it's None.
+        depth (int): The number of sitemap indexes above this
+            document.
+        indexes (dict): The sitemaps listed in each sitemap index, by
+            the URL of the index. It is updated whenever an index is
+            parsed. The sitemaps of an unchanged index are read from it
+            and followed again, since they can change when the index
+            doesn't.
+
+    Yields:
+        dict: An article, either {'url': ..., 'sitemap': {...}} or
+            {'url': ..., 'rss': {...}}.
+    """
+    if chunks is None:
+        if indexes is not None and url in indexes:
+            for article in _follow(indexes[url], fetch, depth, indexes):
+                yield article
+        return
+    events = iter_events(chunks)
+    for event, element in events:
+        schema = etree.QName(element).localname
+        if schema == 'urlset':
+            parser = _iter_sitemap(events, url)
+        elif schema == 'sitemapindex':
+            parser = _iter_sitemap_index(events, url, fetch, depth, indexes)
+        elif schema in ('rss', 'rdf', 'RDF'):
+            parser = _iter_rss(events, element, url)
+        else:
+            print(core.dt() + "No schema detected for: " + url)
+            return
+        for article in parser:
+            yield article
+        return
+
+
+def _crawl(url):
+    # Record the parse time and remove decimal places
+    return {'time': str(int(time.time())), 'url': url}
+
+
+def _iter_sitemap(events, url):
+    crawl = _crawl(url)
+    for event, element in events:
+        if event != 'end' or _name(element, True)[1] != 'url':
+            continue
+        try:
+            if any(_name(c, True)[1] == 'loc' for c in element
+                   if isinstance(c.tag, str)):
+                sitemap = tag_to_dict(element, html=True)
+                if 'lastmod' in sitemap:
+                    sitemap['lastmod_time'] = core.get_time(sitemap['lastmod'])
+                sitemap['crawl'] = crawl
+                yield {'url': sitemap['loc'], 'sitemap': sitemap}
+        except Exception as e:
+            print(
+                core.dt()
+                + "Warning: Skipping invalid <url> in "
+                + url
+                + ": "
+                + str(e)
+            )
+        finally:
+            _release(element)
+
+
+def _iter_sitemap_index(events, url, fetch, depth, indexes):
+    # Collect the sitemap URLs before following them so that the index
+    # isn't held open while its sitemaps are downloaded
+    sitemaps = []
+    for event, element in events:
+        if event == 'end' and etree.QName(element).localname == 'sitemap':
+            loc = element.find('{*}loc')
+            if loc is not None and loc.text:
+                sitemaps.append(loc.text.strip())
+            _release(element)
+    if indexes is not None:
+        indexes[url] = sitemaps
+    for article in _follow(sitemaps, fetch, depth, indexes):
+        yield article
+
+
+def _follow(sitemaps, fetch, depth, indexes):
+    # Parse the sitemaps listed in an index
+    if fetch is None or depth >= MAX_SITEMAP_DEPTH:
+        return
+    for sitemap_url in sitemaps:
+        print(core.dt() + "Crawling sitemap at " + sitemap_url + ".")
+        try:
+            chunks = fetch(sitemap_url)
+        except Exception as e:
+            print(str(e))
+            continue
+        for article in iter_feed(chunks, sitemap_url, fetch, depth + 1,
+                                 indexes):
+            yield article
+
+
+def _iter_rss(events, root, url):
+    crawl = _crawl(url)
+    # Extract the RSS attributes
+    rss_attrs = _attributes(root, False)
+    count = 0
+    for event, element in events:
+        if event != 'end' or etree.QName(element).localname != 'item':
+            continue
+        try:
+            item = tag_to_dict(element)
+            link = item.get('link')
+            if isinstance(link, str):
+                if 'pubDate' in item:
+                    item['pubDate_time'] = core.get_time(item['pubDate'])
+                rss = core.split_namespace(rss_attrs)
+                rss['item'] = item
+                rss['crawl'] = crawl
+                count += 1
+                yield {'url': link, 'rss': rss}
+        except Exception as e:
+            print(
+                core.dt()
+                + "Warning: Skipping invalid <item> in "
+                + url
+                + ": "
+                + str(e)
+            )
+        finally:
+            _release(element)
+    if count == 0:
+        print("! Warning: No <item> tags in URL " + url)
@@ -0,0 +1,155 @@
+#!/usr/bin/python3
+"""fetcher
+
+Fetches many URLs concurrently while staying polite to each host.
+
+Requests to different hosts run in parallel on a bounded thread pool.
+Each host has its own concurrency limit and a delay between requests,
+so that the crawl takes about as long as the slowest host rather than
+the sum of every host. Settings can be overridden in the optional
+'crawler' section of config.yaml:
+
+crawler:
+  max_workers: 16
+  per_host: 2
+  crawl_delay: 1
+"""
+
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlsplit
+
+import core
+
+DEFAULTS = {
+    'max_workers': 16,
+    'per_host': 2,
+    'crawl_delay': 1
+}
+
+
+class PoliteFetcher():
+    """Runs a fetch function over a list of URLs on a thread pool.
+
+    Only the fetching happens on the pool, including each host's
+    robots.txt, which is read before the host's first request. Results
+    are yielded back to the calling thread as they complete, so parsing
+    and storing stay single threaded.
+    """
+
+    def __init__(self, fetch, max_workers=None, per_host=None,
+                 crawl_delay=None, robots=None):
+        """
+        Args:
+            fetch (function): Called with a URL, returns the response.
+            max_workers (int): The maximum number of requests in flight
+                across all hosts.
+            per_host (int): The maximum number of requests in flight to
+                a single host.
+            crawl_delay (int/float): The minimum number of seconds
+                between starting two requests to the same host.
+            robots (RobotsCache): If passed, a Crawl-delay in a host's
+                robots.txt is honoured when it's longer than
+                crawl_delay.
+        """
+        args = dict(DEFAULTS)
+        args.update(core.config().get('crawler', {}))
+        self.fetch = fetch
+        self.max_workers = int(max_workers or args['max_workers'])
+        self.per_host = int(per_host or args['per_host'])
+        if crawl_delay is None:
+            crawl_delay = args['crawl_delay']
+        self.crawl_delay = float(crawl_delay)
+        self.robots = robots
+
+    def _host_delay(self, base_url):
+        """Returns the number of seconds to wait between requests to a
+        host.
+        """
+        delay = self.crawl_delay
+        if self.robots is not None:
+            try:
+                robots_delay = self.robots.get(base_url).crawl_delay('*')
+                if robots_delay is not None:
+                    delay = max(delay, float(robots_delay))
+            except Exception:
+                pass
+        return delay
+
+    def fetch_all(self, urls):
+        """Fetches every URL.
+
+        Args:
+            urls (list): The URLs to fetch.
+
+        Yields:
+            tuple: (url, response, exception) for each URL in the order
+                they complete. response is None if fetch raised, in
+                which case exception holds what it raised.
+        """
+        # Queue the URLs by host
+        queues = OrderedDict()
+        for url in urls:
+            base_url = '{0.scheme}://{0.netloc}/'.format(urlsplit(url))
+            queues.setdefault(base_url, deque()).append(url)
+        if not queues:
+            return
+        in_flight = {}
+        host_active = {host: 0 for host in queues}
+        host_next = {host: 0.0 for host in queues}
+        host_delay = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while queues or in_flight:
+                now = time.time()
+                wake = None
+                # Start requests round-robin across hosts that are
+                # below their limit and past their crawl delay
+                for host in list(queues):
+                    if len(in_flight) >= self.max_workers:
+                        break
+                    if host_active[host] >= self.per_host:
+                        continue
+                    if host_next[host] > now:
+                        if wake is None or host_next[host] < wake:
+                            wake = host_next[host]
+                        continue
+                    if host not in host_delay:
+                        # Read the host's robots.txt on the pool too, so
+                        # that an unreachable host can't hold up the
+                        # others
+                        host_delay[host] = None
+                        future = pool.submit(self._host_delay, host)
+                        in_flight[future] = (host, None)
+                        continue
+                    if host_delay[host] is None:
+                        continue
+                    url = queues[host].popleft()
+                    if not queues[host]:
+                        del queues[host]
+                    future = pool.submit(self.fetch, url)
+                    in_flight[future] = (host, url)
+                    host_active[host] += 1
+                    host_next[host] = now + host_delay[host]
+                if not in_flight:
+                    # Every remaining host is waiting out its delay
+                    time.sleep(max(0, wake - time.time()))
+                    continue
+                timeout = None
+                if wake is not None:
+                    timeout = max(0, wake - time.time())
+                done, _ = wait(in_flight, timeout=timeout,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    host, url = in_flight.pop(future)
+                    if url is None:
+                        # The host's crawl delay is known, start its
+                        # requests
+                        host_delay[host] = future.result()
+                        continue
+                    host_active[host] -= 1
+                    try:
+                        result = (url, future.result(), None)
+                    except Exception as e:
+                        result = (url, None, e)
+                    yield result
@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+"""htmlstore
+
+Keeps the raw HTML of articles out of the body of their CouchDB docs.
+
+The HTML is gzip compressed and stored either as an attachment of the
+article doc or in the NeCTAR Object Store, and article['html'] only
+holds a reference to it. CouchDB doesn't pass attachments to views or
+return them from a plain GET, so the docs stay small. Use get_html() to
+read the HTML back, whichever way it was stored. Where it is stored can
+be set in the optional 'html' section of config.yaml:
+
+html:
+  storage: attachment/object/inline
+"""
+
+import gzip
+import base64
+
+import core
+from comms import web
+
+# The name of the article doc attachment that holds the HTML
+ATTACHMENT = 'html.gz'
+DEFAULT_STORAGE = 'attachment'
+
+
+def storage():
+    """Returns where new HTML is stored: 'attachment', 'object' or
+    'inline' (in the doc body, as it used to be).
+    """
+    return core.config().get('html', {}).get('storage', DEFAULT_STORAGE)
+
+
+def pack(html, obj=None, where=None):
+    """Compresses an article's HTML and returns the fields to add to
+    the article doc.
+
+    Args:
+        html (str): The HTML document.
+        obj (ObjectStore): Required to store HTML in the Object Store.
+        where (str): 'attachment', 'object' or 'inline'. Defaults to
+            storage().
+
+    Returns:
+        dict: 'html' holds the HTML itself (inline) or a reference to
+            it, and '_attachments' holds the attachment if there is
+            one.
+    """
+    if where is None:
+        where = storage()
+    if where == 'inline':
+        return {'html': html}
+    data = gzip.compress(html.encode('utf-8'))
+    ref = {
+        'storage': where,
+        'encoding': 'gzip',
+        'content_type': 'text/html; charset=utf-8',
+        'length': len(data)
+    }
+    if where == 'object':
+        if obj is None:
+            raise ValueError("An ObjectStore is needed to store HTML in it.")
+        ref['url'] = obj.store_content(
+            data,
+            headers={'Content-Type': 'application/gzip'}
+        )
+        return {'html': ref}
+    if where != 'attachment':
+        raise ValueError("Unknown HTML storage: " + str(where))
+    ref['name'] = ATTACHMENT
+    return {
+        'html': ref,
+        '_attachments': {
+            ATTACHMENT: {
+                'content_type': 'application/gzip',
+                'data': base64.b64encode(data).decode('ascii')
+            }
+        }
+    }
+
+
+def get_html(db, article):
+    """Returns the HTML of an article doc, wherever it is stored.
+
+    Args:
+        db (CouchDBComms): The database of articles, used to read
+            attachments.
+        article (dict): The article doc.
+
+    Returns:
+        str: None if the article has no HTML.
+    """
+    ref = article.get('html')
+    # HTML stored in the doc body, including articles stored before
+    # HTML was moved out of it
+    if ref is None or isinstance(ref, str):
+        return ref
+    if ref.get('storage') == 'object':
+        response = web.get(ref['url'])
+        response.raise_for_status()
+        data = response.content
+    else:
+        # Use the inline data if the doc was read with its attachments
+        attachment = article.get('_attachments', {}).get(ref['name'], {})
+        if 'data' in attachment:
+            data = base64.b64decode(attachment['data'])
+        else:
+            f = db._db.get_attachment(article, ref['name'])
+            if f is None:
+                return None
+            data = f.read()
+    if ref.get('encoding') == 'gzip':
+        data = gzip.decompress(data)
+    return data.decode('utf-8')
@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+"""media
+
+Archives the images referenced by articles in the background.
+
+Articles are stored with the original image URLs first. Each image is
+then copied to the Object Store on a bounded pool of worker threads,
+and once every image of an article has been handled the stored article
+is patched to point at the Object Store copies. A slow image host only
+delays its own images, not the articles behind it.
+"""
+
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import couchdb
+
+import core
+
+# Meta tag contents that look like images. Any character may come
+# before the extension, as it always has, so '?format=jpg' matches too.
+IMAGE_RE = re.compile(r'.(?:jpg|jpeg|gif|png|bmp|tiff)', re.IGNORECASE)
+# The number of times a patch is retried if the article is updated by
+# someone else at the same time
+MAX_PATCH_ATTEMPTS = 3
+
+
+def is_image(value):
+    """Returns True if a meta tag value looks like an image URL."""
+    return isinstance(value, str) and IMAGE_RE.search(value) is not None
+
+
+def replace_values(value, replacements):
+    """Replaces every string in a nested structure of dicts and lists
+    that is a key of replacements.
+
+    Returns:
+        tuple: The new value and True if anything was replaced.
+    """
+    if isinstance(value, str):
+        if value in replacements:
+            return replacements[value], True
+        return value, False
+    changed = False
+    if isinstance(value, dict):
+        for k in value:
+            value[k], c = replace_values(value[k], replacements)
+            changed = changed or c
+    elif isinstance(value, list):
+        for i in range(len(value)):
+            value[i], c = replace_values(value[i], replacements)
+            changed = changed or c
+    return value, changed
+
+
+class MediaOffloader():
+    """Stores media in the Object Store on a pool of worker threads and
+    patches the articles that reference it.
+    """
+
+    def __init__(self, obj, db, max_workers=4, max_pending=1000,
+                 fields=('meta', 'ogp')):
+        """
+        Args:
+            obj (ObjectStore): Where media is stored.
+            db (CouchDBComms): The database of articles.
+            max_workers (int): The number of media downloads and
+                uploads in flight.
+            max_pending (int): The maximum number of media URLs
+                waiting to be stored. submit() blocks once there are
+                this many.
+            fields (tuple): The article fields that are patched.
+        """
+        self.obj = obj
+        self.db = db
+        self.fields = fields
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        # Article _id -> [media URLs left, {media URL: object URL}]
+        self._pending = {}
+        # Media URL being stored -> the _ids of the articles waiting
+        # for it
+        self._in_flight = {}
+
+    def submit(self, article_id, urls):
+        """Queues an article's media to be stored. The article should
+        already have been stored (or buffered) with the original URLs.
+        A URL that is already being stored, for this article or another
+        one, isn't stored again.
+
+        Args:
+            article_id (str): The _id of the article doc.
+            urls (iterable): The media URLs the article references.
+        """
+        urls = set(urls)
+        if not urls:
+            return
+        with self._lock:
+            entry = self._pending.setdefault(article_id, [set(), {}])
+            # Add to the article's outstanding media
+            urls -= entry[0] | set(entry[1])
+            entry[0].update(urls)
+            new = []
+            for url in urls:
+                if url in self._in_flight:
+                    self._in_flight[url].add(article_id)
+                else:
+                    self._in_flight[url] = {article_id}
+                    new.append(url)
+        for url in new:
+            # Block while too many URLs are waiting, rather than queue
+            # an unbounded amount of work
+            self._slots.acquire()
+            try:
+                self._pool.submit(self._store, url)
+            except:
+                self._slots.release()
+                raise
+
+    def _store(self, url):
+        """Stores one media URL, then patches each article waiting for
+        it that has no other media left.
+        """
+        object_url = None
+        try:
+            object_url = self.obj.store(url)
+        except Exception as e:
+            print(
+                core.dt()
+                + "Warning: Could not store media "
+                + url
+                + ": "
+                + str(e)
+            )
+        finally:
+            self._slots.release()
+        done = []
+        with self._lock:
+            for article_id in self._in_flight.pop(url):
+                entry = self._pending[article_id]
+                entry[0].discard(url)
+                if object_url is not None:
+                    entry[1][url] = object_url
+                if not entry[0]:
+                    del self._pending[article_id]
+                    done.append((article_id, entry[1]))
+        try:
+            for article_id, replacements in done:
+                try:
+                    if replacements:
+                        self.patch(article_id, replacements)
+                except Exception as e:
+                    print(
+                        core.dt()
+                        + "Warning: Could not patch media URLs in "
+                        + article_id
+                        + ": "
+                        + str(e)
+                    )
+        finally:
+            with self._lock:
+                if not self._pending:
+                    self._idle.notify_all()
+
+    def patch(self, article_id, replacements):
+        """Replaces media URLs in a stored article with their Object
+        Store URLs.
+
+        Args:
+            article_id (str): The _id of the article doc.
+            replacements (dict): Media URLs and their object URLs.
+
+        Returns:
+            bool: True if the article was updated.
+        """
+        for attempt in range(MAX_PATCH_ATTEMPTS):
+            doc = self.db._db.get(article_id)
+            if doc is None:
+                # The article may still be in the bulk write buffer
+                self.db.flush()
+                doc = self.db._db.get(article_id)
+                if doc is None:
+                    print(
+                        core.dt()
+                        + "Warning: Could not patch media URLs, "
+                        + article_id
+                        + " is not in "
+                        + self.db.db_str
+                    )
+                    return False
+            doc = dict(doc)
+            changed = False
+            for field in self.fields:
+                if field in doc:
+                    doc[field], c = replace_values(doc[field], replacements)
+                    changed = changed or c
+            if not changed:
+                return False
+            try:
+                self.db._db.save(doc)
+                return True
+            # Someone else updated the article, read it again
+            except couchdb.http.ResourceConflict:
+                continue
+        print(
+            core.dt()
+            + "Warning: Gave up patching media URLs in "
+            + article_id
+            + " after "
+            + str(MAX_PATCH_ATTEMPTS)
+            + " conflicts."
+        )
+        return False
+
+    def wait(self):
+        """Blocks until every queued article has been patched."""
+        with self._lock:
+            while self._pending:
+                self._idle.wait()
@@ -10,22 +10,27 @@ import re
 import math
 import collections
 import itertools
-import requests
 import zipfile
 from csv import DictReader
 
 import pickle
 
+import numpy
+import scipy.sparse
 import nltk
 import nltk.classify.util
 import nltk.metrics
 from nltk.metrics import BigramAssocMeasures
 from nltk.probability import FreqDist, ConditionalFreqDist
-from nltk.corpus import stopwords
+from nltk.probability import DictionaryProbDist
+from nltk.classify.maxent import BinaryMaxentFeatureEncoding, GISEncoding
 from nltk.classify.scikitlearn import SklearnClassifier
 from sklearn.naive_bayes import BernoulliNB
 from sklearn.linear_model import LogisticRegression
 
+from comms import web
+from nlp import tokenizer
+
 #sys.path.append(os.path.abspath("/home/ubuntu/wa-twitter/harvester/"))
 
 
@@ -46,13 +51,15 @@ class SentimentAnalyser():
 
     def __init__(self):
         """"""
+        # Caches used by analyse_batch()
+        self._best_index = None
+        self._maxent_cache = None
+        self._sklearn_cache = {}
         self._stop_words = self._get_stop_words()
         self._load_pickle_files()
 
     def _get_stop_words(self):
-        punctuation = list(string.punctuation)
-        stop_words = stopwords.words('english') + punctuation + ['AT_USER','URL','rt']
-        return stop_words
+        return tokenizer.get_stop_words()
 
     def _load_pickle_files(self):
         """Loads the pickle files.
@@ -81,7 +88,7 @@ class SentimentAnalyser():
                 return pickle.load(f)
         except:
             url_bucket = "https://swift.rc.nectar.org.au:8888/v1/AUTH_38e73f77f1174084b27c6327aeb9590c/wa-classifiers/"
-            r = requests.get(url_bucket + filename)
+            r = web.get(url_bucket + filename)
             with open(filename, 'wb') as f:
                 f.write(r.content)
             return pickle.loads(r.content)
@@ -108,12 +115,68 @@ class SentimentAnalyser():
         prob_pos = (ME_prob_pos + BerNB_prob_pos + LR_prob_pos)/3
         prob_neg = (ME_prob_neg + BerNB_prob_neg + LR_prob_neg)/3
 
+        return self._sentiment_dict(
+            feature_vector,
+            feature_vector_best,
+            prob_pos,
+            prob_neg
+        )
+
+    def analyse_batch(self, tweet_texts):
+        """Analyses a batch of tweets.
+
+        Returns the same dicts as calling analyse() on each tweet, but
+        the batch is turned into one sparse feature matrix over
+        _best_words and each classifier scores the whole matrix at
+        once.
+
+        Args:
+            tweet_texts (list): The text of each tweet.
+
+        Returns:
+            list: A dict for each tweet, in the same format as
+                analyse().
+        """
+        feature_vectors = [
+            self._get_feature_vector(self._process_tweet(t))
+            for t in tweet_texts
+        ]
+        feature_vectors_best = [
+            self._best_word_features(f) for f in feature_vectors
+        ]
+        if not feature_vectors_best:
+            return []
+        matrix = self._feature_matrix(feature_vectors_best)
+
+        ME_probs = self._maxent_prob_batch(matrix, feature_vectors_best)
+        BerNB_probs = self._sklearn_prob_batch(self.BerNB_classifier, matrix)
+        LR_probs = self._sklearn_prob_batch(self.LR_classifier, matrix)
+
+        results = []
+        for i in range(len(feature_vectors)):
+            prob_pos = (
+                ME_probs[i][0] + BerNB_probs[i][0] + LR_probs[i][0]
+            )/3
+            prob_neg = (
+                ME_probs[i][1] + BerNB_probs[i][1] + LR_probs[i][1]
+            )/3
+            results.append(self._sentiment_dict(
+                feature_vectors[i],
+                feature_vectors_best[i],
+                prob_pos,
+                prob_neg
+            ))
+        return results
+
+    def _sentiment_dict(self, feature_vector, feature_vector_best,
+                        prob_pos, prob_neg):
+        """Builds the dict returned by analyse() and analyse_batch()."""
         if(prob_pos > 0.7):
             sentiment = 'positive'
         elif (prob_neg > 0.7):
-    	    sentiment = 'negative'
+            sentiment = 'negative'
         else:
-    	    sentiment = 'neutral'
+            sentiment = 'neutral'
 
         sentiment_dict = {
             'features': list(feature_vector_best.keys()),
@@ -127,40 +190,168 @@ class SentimentAnalyser():
         }
         return return_dict
 
+    def _best_words_index(self):
+        """Returns a dict that maps each of the _best_words to a column
+        of the batch feature matrix. Built once per set of best words.
+        """
+        if self._best_index is None \
+                or self._best_index[0] is not self._best_words:
+            index = {w: i for i, w in enumerate(sorted(self._best_words))}
+            self._best_index = (self._best_words, index)
+        return self._best_index[1]
+
+    def _feature_matrix(self, feature_vectors_best):
+        """Returns a sparse binary matrix with a row for each
+        featureset and a column for each of the _best_words.
+
+        The columns of each row are kept in the order of the featureset
+        so that the MaxEnt weights are summed in the same order as
+        MaxentClassifier.prob_classify().
+        """
+        index = self._best_words_index()
+        indices = []
+        indptr = [0]
+        for featureset in feature_vectors_best:
+            indices.extend(index[w] for w in featureset)
+            indptr.append(len(indices))
+        data = numpy.ones(len(indices))
+        return scipy.sparse.csr_matrix(
+            (data, numpy.array(indices, dtype=numpy.intc), indptr),
+            shape=(len(feature_vectors_best), len(index))
+        )
+
+    def _maxent_model(self):
+        """Returns the MaxEnt weights laid out over the batch feature
+        matrix columns, or None if the classifier's encoding can not be
+        expressed as a matrix product.
+
+        Returns:
+            dict: labels (list), weights (one column vector per label),
+                counts (the number of joint-features each column fires
+                per label), alwayson (weight per label or None), and
+                correction (the GIS (weight, C) or None).
+        """
+        classifier = self.ME_classifier
+        index = self._best_words_index()
+        model = self._maxent_cache
+        if model is not None and model[0] is classifier \
+                and model[1] is index:
+            return model[2]
+        encoding = classifier._encoding
+        if not classifier._logarithmic or type(encoding) not in (
+                BinaryMaxentFeatureEncoding, GISEncoding):
+            model = None
+        else:
+            labels = list(encoding.labels())
+            weights = classifier._weights
+            mapping = encoding._mapping
+            unseen = encoding._unseen or {}
+            alwayson = encoding._alwayson or {}
+            model = {
+                'labels': labels,
+                'weights': [],
+                'counts': [],
+                'alwayson': [],
+                'correction': None
+            }
+            for label in labels:
+                w = numpy.zeros(len(index))
+                c = numpy.zeros(len(index))
+                for word, i in index.items():
+                    f_id = mapping.get((word, True, label))
+                    # Fire the "unseen-value feature" as encode() does
+                    if f_id is None and word in unseen and not any(
+                            (word, True, l) in mapping
+                            for l in encoding._labels):
+                        f_id = unseen[word]
+                    if f_id is not None:
+                        w[i] = weights[f_id]
+                        c[i] = 1
+                model['weights'].append(w)
+                model['counts'].append(c)
+                if label in alwayson:
+                    model['alwayson'].append(weights[alwayson[label]])
+                else:
+                    model['alwayson'].append(None)
+            if type(encoding) is GISEncoding:
+                base_length = BinaryMaxentFeatureEncoding.length(encoding)
+                model['correction'] = (weights[base_length], encoding.C)
+        self._maxent_cache = (classifier, index, model)
+        return model
+
+    def _maxent_prob_batch(self, matrix, feature_vectors_best):
+        """Returns a (pos, neg) probability tuple for each row of the
+        matrix, identical to MaxentClassifier.prob_classify().
+        """
+        model = self._maxent_model()
+        # Fall back to classifying one featureset at a time
+        if model is None:
+            probs = []
+            for featureset in feature_vectors_best:
+                dist = self.ME_classifier.prob_classify(featureset)
+                probs.append((dist.prob("pos"), dist.prob("neg")))
+            return probs
+        totals = []
+        for label_i in range(len(model['labels'])):
+            total = matrix.dot(model['weights'][label_i])
+            count = matrix.dot(model['counts'][label_i])
+            if model['alwayson'][label_i] is not None:
+                total = total + model['alwayson'][label_i]
+                count = count + 1
+            if model['correction'] is not None:
+                weight, C = model['correction']
+                if (count >= C).any():
+                    raise ValueError("Correction feature is not high enough!")
+                total = total + weight * (C - count)
+            totals.append(total.tolist())
+        probs = []
+        for row in zip(*totals):
+            # Normalise the log probabilities in the same way as
+            # prob_classify()
+            dist = DictionaryProbDist(
+                dict(zip(model['labels'], row)),
+                log=True,
+                normalize=True
+            )
+            probs.append((dist.prob("pos"), dist.prob("neg")))
+        return probs
+
+    def _sklearn_prob_batch(self, classifier, matrix):
+        """Returns a (pos, neg) probability tuple for each row of the
+        matrix using a single predict_proba() call.
+        """
+        index = self._best_words_index()
+        cache = self._sklearn_cache
+        key = id(classifier)
+        if key not in cache or cache[key][0] is not classifier \
+                or cache[key][1] is not index:
+            # Map the batch matrix columns onto the columns that the
+            # classifier's DictVectorizer was fitted with
+            vocabulary = classifier._vectorizer.vocabulary_
+            rows = []
+            cols = []
+            for word, j in vocabulary.items():
+                if word in index:
+                    rows.append(index[word])
+                    cols.append(j)
+            projection = scipy.sparse.csr_matrix(
+                (numpy.ones(len(rows)), (rows, cols)),
+                shape=(len(index), len(vocabulary))
+            )
+            classes = list(classifier._encoder.classes_)
+            cache[key] = (classifier, index, projection,
+                          classes.index("pos"), classes.index("neg"))
+        _, _, projection, pos, neg = cache[key]
+        X = matrix.dot(projection)
+        X.sort_indices()
+        y_proba = classifier._clf.predict_proba(X)
+        return [(p[pos], p[neg]) for p in y_proba]
+
     def _process_tweet(self, tweet):
-        # Convert to lower case
-        tweet = tweet.lower()
-        # Convert www.* or https?://* to URL
-        tweet = re.sub('((www\.[^\s]+)|(https?://[^\s]+))','URL',tweet)
-        # Convert @username to AT_USER
-        tweet = re.sub('@[^\s]+','AT_USER',tweet)
-        # Remove additional white spaces
-        tweet = re.sub('[\s]+', ' ', tweet)
-        # Replace #hashtag with word
-        tweet = re.sub(r'#([^\s]+)', r'\1', tweet)
-        # Trim
-        tweet = tweet.strip('\'"')
-        return tweet
+        return tokenizer.process_tweet(tweet)
 
     def _get_feature_vector(self, tweet):
-        feature_vector = []
-        # Split tweet text into words
-        words = tweet.split()
-
-        for w in words:
-            # Replace two or more with two occurrences
-            pattern = re.compile(r"(.)\1{1,}", re.DOTALL)
-            w = pattern.sub(r"\1\1", w)
-            # Strip punctuation
-            w = w.strip('\'"?,.')
-            # Check if the word starts with an alphabet
-            val = re.search(r"^[a-zA-Z][a-zA-Z0-9]*$", w)
-    	    # Ignore if it is a stop word
-            if (w in self._stop_words or val is None):
-                continue
-            else:
-                feature_vector.append(w.lower())
-        return feature_vector
+        return tokenizer.get_feature_vector(tweet, self._stop_words)
 
     def _best_word_features(self, words):
         return dict([(word, True) for word in words if word in self._best_words])
@@ -193,12 +384,12 @@ class SentimentAnalyser():
         negfeats=[]
         posfeats=[]
         for twe in neg_tweets:
-            processedTweet = _process_tweet(twe)
-            negfeats.append((feature_select(_get_feature_vector(processedTweet)), 'neg'))
+            features = tokenizer.tokenize(twe, self._stop_words)
+            negfeats.append((feature_select(features), 'neg'))
 
         for twe in pos_tweets:
-            processedTweet = _process_tweet(twe)
-            posfeats.append((feature_select(_get_feature_vector(processedTweet)), 'pos'))
+            features = tokenizer.tokenize(twe, self._stop_words)
+            posfeats.append((feature_select(features), 'pos'))
         return posfeats, negfeats
 
     def train_Classifier(self, posfeats, negfeats, index):
@@ -263,7 +454,7 @@ class SentimentAnalyser():
     def download_sentiment_training_dataset(self):
         url = 'http://thinknook.com/wp-content/uploads/2012/09/Sentiment-Analysis-Dataset.zip'
 
-        r = requests.get(url)
+        r = web.get(url)
         z = zipfile.ZipFile(io.BytesIO(r.content))
         z.extractall()
 
@@ -309,12 +500,10 @@ class SentimentAnalyser():
         posWords = []
         negWords = []
         for twe in neg_tweets:
-            processedTweet = processTweet(twe)
-            negWords.append(_get_feature_vector(processedTweet))
+            negWords.append(tokenizer.tokenize(twe, self._stop_words))
 
         for twe in pos_tweets:
-            processedTweet = processTweet(twe)
-            posWords.append(_get_feature_vector(processedTweet))
+            posWords.append(tokenizer.tokenize(twe, self._stop_words))
 
         posWords = list(itertools.chain(*posWords))
         negWords = list(itertools.chain(*negWords))
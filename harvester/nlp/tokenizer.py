@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+"""nlp.tokenizer
+
+Turns tweet text into the word features used for sentiment analysis.
+Shared by SentimentAnalyser.analyse() and the training code so that
+both extract exactly the same features.
+"""
+
+import re
+import string
+
+from nltk.corpus import stopwords
+
+# Matches, in order of precedence: URLs, @usernames, runs of whitespace
+# and #hashtags. Each URL/@username match runs to the end of the word,
+# which is what lets one pass replace the four chained re.sub() calls
+# that used to do this.
+_TWEET_RE = re.compile(
+    r'(?P<url>www\.[^\s]+|https?://[^\s]+)'
+    r'|(?P<user>@[^\s]+)'
+    r'|(?P<space>[\s]+)'
+    r'|#(?P<tag>[^\s]+)'
+)
+# URLs and @usernames inside the rest of a #hashtag
+_URL_USER_RE = re.compile(r'(?P<url>www\.[^\s]+|https?://[^\s]+)|@[^\s]+')
+# Two or more occurrences of the same character
+_REPEAT_RE = re.compile(r"(.)\1{1,}", re.DOTALL)
+# Words that start with a letter and only contain letters and digits
+_WORD_RE = re.compile(r"[a-zA-Z][a-zA-Z0-9]*$")
+
+_stop_words = None
+
+
+def get_stop_words():
+    """Returns a frozenset of the words that are never used as
+    features: English stop words, punctuation, 'AT_USER', 'URL' and
+    'rt'.
+    """
+    global _stop_words
+    if _stop_words is None:
+        _stop_words = frozenset(
+            stopwords.words('english')
+            + list(string.punctuation)
+            + ['AT_USER', 'URL', 'rt']
+        )
+    return _stop_words
+
+
+def _replace_url_user(match):
+    if match.group('url') is not None:
+        return 'URL'
+    return 'AT_USER'
+
+
+def _replace(match):
+    if match.group('url') is not None:
+        return 'URL'
+    if match.group('user') is not None:
+        return 'AT_USER'
+    if match.group('space') is not None:
+        return ' '
+    # Drop the # from a hashtag, the rest of the word still needs its
+    # URLs and @usernames replaced
+    return _URL_USER_RE.sub(_replace_url_user, match.group('tag'))
+
+
+def process_tweet(tweet):
+    """Normalises tweet text in a single pass.
+
+    The text is lower cased, URLs become 'URL', @usernames become
+    'AT_USER', whitespace is collapsed, hashtags lose their # and
+    surrounding quotes are trimmed.
+
+    Args:
+        tweet (str): The tweet text.
+
+    Returns:
+        str:
+    """
+    return _TWEET_RE.sub(_replace, tweet.lower()).strip('\'"')
+
+
+def get_feature_vector(tweet, stop_words=None):
+    """Returns the list of word features in a processed tweet.
+
+    Args:
+        tweet (str): Tweet text returned by process_tweet().
+        stop_words (frozenset): Words to ignore. Defaults to
+            get_stop_words().
+
+    Returns:
+        list:
+    """
+    if stop_words is None:
+        stop_words = get_stop_words()
+    feature_vector = []
+    append = feature_vector.append
+    for w in tweet.split():
+        # Replace two or more with two occurrences and strip
+        # punctuation
+        w = _REPEAT_RE.sub(r"\1\1", w).strip('\'"?,.')
+        # Ignore stop words and words that don't start with a letter
+        if w in stop_words or _WORD_RE.match(w) is None:
+            continue
+        append(w.lower())
+    return feature_vector
+
+
+def tokenize(tweet, stop_words=None):
+    """Returns the list of word features in raw tweet text."""
+    return get_feature_vector(process_tweet(tweet), stop_words)
@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+"""ogp
+
+Intuits an Open Graph object for an article from its meta tags and the
+sitemap or RSS feed it was found in.
+
+The properties that are taken from other fields are listed in RULES,
+which is compiled once at import. Use intuit_og_many() to intuit the
+objects of a batch of articles.
+"""
+
+import core
+
+
+def _publish_time(ogp):
+    # wa:publish_time
+    if 'article' in ogp:
+        if 'published_time' in ogp['article']:
+            publish_time = core.get_time(ogp['article']['published_time'])
+            ogp['wa']['publish_time'] = publish_time
+        elif 'modified_time' in ogp['article']:
+            publish_time = core.get_time(ogp['article']['modified_time'])
+            ogp['wa']['publish_time'] = publish_time
+
+
+def _author(ogp):
+    try:
+        author = ogp['article']['author']
+        if isinstance(author, str):
+            ogp['article']['author'] = {'username': author}
+    except KeyError:
+        pass
+
+
+def _tags(ogp):
+    try:
+        tag = ogp['article']['tag']
+        if isinstance(tag, str):
+            tag = tag.split(',')
+            for i in range(0, len(tag)):
+                tag[i] = tag[i].strip()
+            ogp['article']['tag'] = tag
+        elif isinstance(tag, dict):
+            if 'content' in tag:
+                ogp['article']['tag'] = [tag['content']]
+            else:
+                ogp['article']['tag'] = list(tag)
+        elif isinstance(tag, list):
+            for i in range(0, len(tag)):
+                if isinstance(tag[i], dict):
+                    if 'content' in tag[i]:
+                        ogp['article']['tag'][i] = tag[i]['content']
+    except KeyError:
+        pass
+
+
+# The Open Graph properties taken from other fields of the article, in
+# the order they are applied. Each rule is the property, the fields it
+# is taken from in order of preference, and a function to call with the
+# Open Graph object afterwards (or None). A property that is already
+# set is left alone. Otherwise the first field that exists is used,
+# unless its value is None.
+#
+# article:section - string - A high-level section name. E.g. Technology
+RULES = [
+    ('og:title', [
+        'meta:twitter:title',
+        'rss:item:title',
+        'meta:title'
+    ], None),
+    ('og:image', [
+        'meta:twitter:image',
+        'rss:channel:image'
+    ], None),
+    ('og:description', [
+        'meta:twitter:description',
+        'meta:description',
+        'rss:item:description'
+    ], None),
+    ('og:site_name', [
+        'rss:channel:title'
+    ], None),
+    ('article:published_time', [
+        'rss:item:pubDate',
+        'rss:item:dc:date'
+    ], None),
+    ('article:modified_time', [
+        'meta:og:updated_time',
+        'sitemap:lastmod'
+    ], _publish_time),
+    ('article:author', [
+        'meta:article:author',
+        'rss:item:dc:creator'
+    ], _author),
+    # article:tag - string array
+    ('article:tag', [
+        'rss:item:category',
+        'meta:keywords'
+    ], _tags)
+]
+# The namespaces copied from the meta tags
+META_NAMESPACES = ['og', 'article', 'music', 'video', 'book', 'profile']
+
+# A field that doesn't exist
+_MISSING = object()
+
+
+def _compile(rules):
+    """Splits the paths in a table of rules into tuples of keys."""
+    return tuple(
+        (tuple(prop.split(':')), tuple(tuple(f.split(':')) for f in fields),
+         then)
+        for prop, fields, then in rules
+    )
+
+
+_RULES = _compile(RULES)
+
+
+def _get(d, path):
+    """Returns the value at a path of keys in nested dicts, or _MISSING.
+    """
+    try:
+        for key in path:
+            d = d[key]
+        return d
+    except KeyError:
+        return _MISSING
+
+
+def _put(ogp, path, value):
+    """Sets the value at a path of keys in the Open Graph object, in the
+    same way as core.merge().
+    """
+    parent = ogp
+    for key in path[:-1]:
+        child = parent.get(key, _MISSING)
+        if child is _MISSING:
+            parent[key] = child = {}
+        elif not isinstance(child, dict):
+            break
+        parent = child
+    else:
+        if path[-1] not in parent:
+            parent[path[-1]] = value
+            return
+    # Let merge() resolve conflicts with values that are already there
+    for key in reversed(path):
+        value = {key: value}
+    core.merge(ogp, value)
+
+
+def _intuit(article, rules):
+    ogp = {'wa': {'outlet': article['outlet']}}
+    if 'meta' in article:
+        for key in META_NAMESPACES:
+            if key in article['meta']:
+                ogp[key] = article['meta'][key]
+
+    if 'og' not in ogp:
+        ogp['og'] = {}
+    ogp['og']['url'] = article['url']
+    for prop, fields, then in rules:
+        current = _get(ogp, prop)
+        if current is _MISSING or current is None:
+            # Use the first field that exists
+            for field in fields:
+                value = _get(article, field)
+                if value is not _MISSING:
+                    if value is not None:
+                        _put(ogp, prop, value)
+                    break
+        if then is not None:
+            then(ogp)
+    return ogp
+
+
+def intuit_og(article):
+    """Construct an Open Graph object.
+
+    Args:
+        article (dict): Requires 'url' and 'outlet' as keys.
+
+    Returns:
+        dict:
+
+    Todo:
+        * If using an RSS description which contains HTML markup,
+            we should process the content using BeautifulSoup to
+            extract both text ('og:description') and an <img>
+            ('og:image') if one exists.
+        * Support the following properties:
+            og:type, og:audio, og:video
+        * Perhaps rename the method (infer, deduce, interpet)
+    """
+    return _intuit(article, _RULES)
+
+
+def intuit_og_many(articles):
+    """Construct the Open Graph objects of many articles. See
+    intuit_og().
+
+    Args:
+        articles (iterable): dicts.
+
+    Yields:
+        dict: The Open Graph object of each article, in order.
+    """
+    rules = _RULES
+    for article in articles:
+        yield _intuit(article, rules)
@@ -4,21 +4,29 @@
 Harvests open graph data from XML sitemaps and RSS feeds.
 """
 
-import re
-import requests
 import time
-from urllib import robotparser
+import functools
 from urllib.parse import urlsplit
 
 import facebook
-import bs4
 from bs4 import BeautifulSoup
 
 #sys.path.append(os.path.abspath("/home/ubuntu/wa-twitter/harvester/"))
 
 import core
+import extract
+import feeds
+import htmlstore
+import ogp
+from comms import web
 from comms.couchdb import CouchDBComms as db
 from comms.nectar import ObjectStore
+from robots import RobotsCache
+from fetcher import PoliteFetcher
+from scheduler import FeedScheduler
+from urlindex import ArticleIndex
+from media import MediaOffloader, replace_values
+from reprocess import Reprocessor
 
 
 class OGHarvester():
@@ -33,12 +41,36 @@ class OGHarvester():
         """"""
         # Connect to the outlets database
         self.db_outlets = db('outlets')
-        # Connect to database to store articles
-        self.db_articles = db('articles')
+        # Connect to database to store articles. Articles are written
+        # in bulk and the buffer is flushed at the end of each cycle.
+        self.db_articles = db('articles', bulk_size=20)
+        # The URLs of the articles already in the database
+        self.article_index = ArticleIndex(self.db_articles)
+        # Connect to the database of sitemap and RSS feed crawl state.
+        # Feed validators are loaded once and kept in memory.
+        self.db_crawler = db('crawler', bulk_size=50)
+        self.feed_states = self.db_crawler.get_feed_states()
+        # The validators of the feeds read this cycle, by feed URL.
+        # See iter_validated()
+        self.new_validators = {}
+        # The sitemaps listed in each sitemap index, so that they are
+        # still polled when the index itself hasn't changed
+        self.sitemap_indexes = {
+            url: state['sitemaps'] for url, state in self.feed_states.items()
+            if state.get('sitemaps') is not None
+        }
+        # Decides when each feed is next polled
+        self.scheduler = FeedScheduler(self.feed_states)
         # Connect to the Object Store to store media files
         self.obj = ObjectStore('wa-opengraph')
-
-    def parse_url(self, url, force=False):
+        # Stores article images in the background
+        self.media = MediaOffloader(self.obj, self.db_articles)
+        # robots.txt rules for every host we crawl
+        self.robots = RobotsCache()
+        # Fetches articles from different hosts in parallel
+        self.fetcher = PoliteFetcher(self.parse_url, robots=self.robots)
+
+    def parse_url(self, url, force=False, stream=False, headers=None):
         """Attempt to GET a given URL.
 
         This method ensures that the exception handling is consistent
@@ -48,6 +80,11 @@ class OGHarvester():
             url (str): The URL to be parsed.
             force (bool): Set to True to ignore robots.txt advice.
                 False by default.
+            stream (bool): Set to True to download the response body
+                as it is read (see iter_response()).
+            headers (dict): Extra request headers. If they make the
+                request conditional (If-None-Match/If-Modified-Since)
+                a 304 response is returned rather than raised.
 
         Returns:
             requests.models.Response:
@@ -58,12 +95,10 @@ class OGHarvester():
         if force is False:
             # Find base URL from URL
             base_url = '{0.scheme}://{0.netloc}/'.format(urlsplit(url))
-            # Test if the robots.txt file allows search engine access
-            rp = robotparser.RobotFileParser()
-            rp.set_url(base_url + 'robots.txt')
-            rp.read()
-            # Raise an exception if we are not allowed access to URL
-            if rp.can_fetch('*', url) is False:
+            # Test if the (cached) robots.txt file allows search engine
+            # access. Raise an exception if we are not allowed access
+            # to URL
+            if self.robots.can_fetch(url) is False:
                 raise Exception(
                     base_url
                     + "robots.txt rejected crawler access to: "
@@ -72,7 +107,7 @@ class OGHarvester():
 
         # Attempt to retrieve the URL
         try:
-            response = requests.get(url)
+            response = web.get(url, stream=stream, headers=headers)
         except ConnectionError as e:
             #print ("Invalid URL or network error.")
             raise
@@ -80,7 +115,9 @@ class OGHarvester():
             #print ("Could not retrieve URL: " + url)
             raise
         # Raise an exception if not a successful HTTP status code
-        if response.status_code != 200:
+        not_modified = response.status_code == 304 and bool(headers)
+        if response.status_code != 200 and not not_modified:
+            response.close()
             raise Exception(
                 "Invalid response from the URL ("
                 + url
@@ -90,486 +127,260 @@ class OGHarvester():
             )
         return response
 
-    def parse_sitemap(self, url):
-        """Returns a dict of URLs based on an XML sitemap
+    def iter_response(self, response, chunk_size=65536):
+        """Yields the body of a response in chunks and closes the
+        response once it has been read.
+        """
+        try:
+            for chunk in response.iter_content(chunk_size):
+                yield chunk
+        finally:
+            response.close()
+
+    def fetch_feed(self, url):
+        """Fetches a feed and returns its body as an iterable of
+        chunks, for the streaming parsers in feeds.
+
+        The request is conditional on the ETag and Last-Modified date
+        from the last time the feed was read, so an unchanged feed
+        returns None and isn't parsed at all. For a sitemap index, the
+        sitemaps it listed are still followed (see feeds.iter_feed()).
+        """
+        state = self.feed_states.get(url, {})
+        headers = {}
+        if state.get('etag'):
+            headers['If-None-Match'] = state['etag']
+        if state.get('last_modified'):
+            headers['If-Modified-Since'] = state['last_modified']
+        response = self.parse_url(url, stream=True, headers=headers)
+        if response.status_code == 304:
+            response.close()
+            print("Not modified. ", end="")
+            return None
+        return self.iter_validated(url, response)
+
+    def iter_validated(self, url, response):
+        """Yields the body of a feed in chunks. Once the whole body has
+        been read the feed's validators are held in new_validators,
+        until iterate() has stored every new article the feed listed.
+        A feed that fails to download or parse, or whose articles
+        aren't all stored, is fetched in full next time.
+        """
+        for chunk in self.iter_response(response):
+            yield chunk
+        self.new_validators[url] = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified')
+        }
+
+    def update_feed_state(self, url, validators):
+        """Records the ETag and Last-Modified headers of a feed
+        response in the crawler database, if they have changed.
+        """
+        state = self.feed_states.setdefault(url, {'_id': url})
+        if any(state.get(k) != v for k, v in validators.items()):
+            state.update(validators)
+            self.db_crawler.store_feed_state(state)
+
+    def iter_feed(self, url, response=None):
+        """Yields the articles in an XML sitemap, sitemap index or RSS
+        feed as the document is downloaded and parsed.
+
+        This method does not raise any exceptions. It prints a warning
+        and stops if the URL or the document is invalid.
+
+        Args:
+            url (str): The URL of the sitemap or feed to be parsed.
+            response (requests.models.Response): The already fetched
+                document. The URL is fetched if this isn't passed.
+
+        Yields:
+            dict: {'url': ..., 'sitemap': {...}} for each <url> in a
+                sitemap and {'url': ..., 'rss': {...}} for each <item>
+                in an RSS feed.
+        """
+        # Attempt to retrieve the URL, unless it hasn't changed
+        try:
+            if response is None:
+                chunks = self.fetch_feed(url)
+            else:
+                chunks = self.iter_response(response)
+        except Exception as e:
+            print(str(e))
+            return
+        try:
+            for article in feeds.iter_feed(chunks, url,
+                                           fetch=self.fetch_feed,
+                                           indexes=self.sitemap_indexes):
+                yield article
+        except Exception as e:
+            print(str(e))
 
-        Need to modify the method to be able to parse multiple:
-        <image:image>
-            <image:loc></image:loc>
-            <image:caption></image:caption>
-        </image:image>
+    def parse_sitemap(self, url, response=None):
+        """Returns a dict of URLs based on an XML sitemap. The sitemaps
+        listed in a sitemap index are followed.
 
         Args:
             url (str): The URL of the XML sitemap to be parsed.
+            response (requests.models.Response): The already fetched
+                sitemap. The URL is fetched if this isn't passed.
 
         Returns:
-            dict:
-
-        Raises:
-            Raises any exceptions caught from attemping to GET the
-            URL, and raises an Exception if the response content does
-            not contain a valid XML sitemap schema.
+            dict: Empty if invalid URL.
         """
         print(core.dt() + "Crawling sitemap at " + url + ". ", end="")
-        # Create an empty dict for the articles
         articles = {}
-        # Attempt to retrieve the URL
-        try:
-            response = self.parse_url(url)
-        except Exception as e:
-            print(str(e))
-            return articles
-            #raise
-        # Record the parse time and remove decimal places
-        parse_time = int(time.time())
-        # Record crawl data
-        crawl = {'time': str(parse_time), 'url': url}
-        # Use BeautifulSoup to parse the web page
-        soup = BeautifulSoup(response.content, "lxml")
-        # Find all <url> tags in the web page
-        urls = soup.findAll('url')
-        # Raise an exception if there are no <url> tags in the web page
-        if not urls:
-            #raise Exception("The URL (" + url + ") contains no <url> tags.")
-            return articles
-        # Extract the data for each URL into a dict
-        for u in urls:
-            if u.find('loc') is not None:
-                sitemap = self.parse_tag(u)
-                if 'lastmod' in sitemap:
-                    sitemap['lastmod_time'] = core.get_time(sitemap['lastmod'])
-                sitemap['crawl'] = crawl
-                articles[sitemap['loc']] = {'url': sitemap['loc'],
-                    'sitemap': sitemap}
-        # Return the dict
+        for article in self.iter_feed(url, response):
+            articles[article['url']] = article
         return articles
 
-    def parse_rss(self, url):
+    def parse_rss(self, url, response=None):
         """
         This method currently does not raise any exceptions. It returns
         an empty dict with a warning if the URL is invalid.
 
         Args;
             url (str): The URL of the RSS feed to be parsed.
+            response (requests.models.Response): The already fetched
+                feed. The URL is fetched if this isn't passed.
 
         Returns:
             dict: Empty if invalid URL.
         """
         print(core.dt() + "Crawling RSS feed at " + url + ". ", end="")
-        # Create an empty dict for the articles
         articles = {}
-        # Attempt to retrieve the URL
-        try:
-            response = self.parse_url(url)
-        except:
-            print("! Warning: No response from URL " + url)
-            return articles
-            # raise
-        # Record the parse time and remove decimal places
-        parse_time = int(time.time())
-        # Record crawl data
-        crawl = {'time': str(parse_time), 'url': url}
-        # Use BeautifulSoup to parse the web page
-        soup = BeautifulSoup(response.content, 'xml')
-        # Find all <item> tags in the web page
-        items = soup.findAll('item')
-        # Raise an exception if there are no <item> tags in the web page
-        if not items:
-            # raise Exception("The URL (" + url + ") contains no <item> tags.")
-            print("! Warning: No <item> tags in URL " + url)
-            return articles
-        # Extract the RSS attributes
-        rss_tag = soup.find('rss')
-        if rss_tag is None:
-            rss_tag = soup.find('rdf')
-        if rss_tag is None:
-            rss_tag = soup.find('RDF')
-        rss_attrs = self.split_namespace(rss_tag.attrs)
-        #print(rss_tag.attrs)
-        # Extract the channel information
-        channel = {}
-        channel_soup = soup.find('channel')
-        for e in channel_soup(['item']):
-            e.extract()
-        channel = self.parse_tag(channel_soup)
-        # Extract the data for each URL into a dict
-        for i in items:
-            if i.find('link') is not None:
-                item = self.parse_tag(i)
-                if 'pubDate' in item:
-                    item['pubDate_time'] = core.get_time(item['pubDate'])
-                rss = rss_attrs
-                rss['item'] = item
-                rss['crawl'] = crawl
-                articles[item['link']] = {'url': item['link'],
-                    'rss': rss}
-        # Return the dict
+        for article in self.iter_feed(url, response):
+            articles[article['url']] = article
         return articles
 
     def parse_tag(self, tags):
-        """This method takes a bs4.element.Tag as an input and returns
-        a dict.
+        """This method takes a bs4.element.Tag (or an lxml element) as an
+        input and returns a dict. See feeds.tag_to_dict().
+        """
+        return feeds.tag_to_dict(tags)
 
-        Preserves duplicate tags by creating a list of dicts.
-        Preserves namespaces
-        Preserves attributes by creating dict (normally <key>value</key> to
-        be compact, but <key subkey="subvalue">content="subvalue"</key> if
-        needed)
+    def is_media(self, url):
+        """Returns True if the URL is for media content that should not
+        be parsed.
+        """
+        return url.endswith('.mp3') or url.endswith('.pdf')
+
+    def fetch_articles(self, urls):
+        """Fetches articles concurrently with the PoliteFetcher.
 
-        For simplicity in code, tags wtihout a namespace are assigned one.
+        Args:
+            urls (list): The article URLs.
 
-        Mostly if/else because bs4 does not throw many exceptions
+        Yields:
+            tuple: (url, response, exception) as the fetches complete.
+                Media URLs are yielded first with no response, since
+                they are not fetched.
         """
-        return_dict = {}
-        for tag in tags:
-            if type(tag) is bs4.element.Tag:
-                tag_dict = {}
-                # Assign a namespace for this tag
-                if tag.prefix is not None:
-                    namespace = tag.prefix
-                else:
-                    namespace = 'none'
-                if namespace not in return_dict:
-                    return_dict[namespace] = {}
-                # If this tag has children tags
-                if bool(tag.findChildren()) is True:
-                    tag_dict = self.parse_tag(tag)
-                    # Kill any namespaces from child tags, although
-                    # they can be retained if needed (remove code)
-                    if tag.prefix in tag_dict:
-                        tag_dict = tag_dict[tag.prefix]
-                # Store the tag contents
-                else:
-                    if bool(tag.attrs) is True:
-                        tag_dict = tag.attrs
-                        tag_dict['content'] = tag.string
-                    else:
-                        tag_dict = tag.string
-
-                # If there is already a tag there with the same name, it needs to be a list
-                if tag.name in return_dict[namespace]:
-                    # Make it a list if not one already
-                    if type(return_dict[namespace][tag.name]) is not list:
-                        tmp_dict = return_dict[namespace][tag.name]
-                        return_dict[namespace][tag.name] = [tmp_dict]
-                    # Append new data
-                    return_dict[namespace][tag.name].append(tag_dict)
-                # Else save the new tag
-                else:
-                    return_dict[namespace][tag.name] = tag_dict
-
-        # Move 'none' namespace dict into parent dict, if 'none' exists
-        return_dict.update(return_dict.pop('none', {}))
-        # Return the dict
-        return return_dict
-
-    def parse_article(self, url):
+        for url in urls:
+            if self.is_media(url):
+                yield url, None, None
+        for result in self.fetcher.fetch_all(
+            [url for url in urls if not self.is_media(url)]
+        ):
+            yield result
+
+    def parse_article(self, url, response=None, media=None):
         """Returns metadata for a webpage.
+
+        Args:
+            url (str): The URL of the article.
+            response (requests.models.Response): The already fetched
+                article. The URL is fetched if this isn't passed.
+            media (set): If passed, image URLs in the meta tags are
+                added to it and left as they are, to be stored later by
+                the MediaOffloader. Otherwise they are stored in the
+                Object Store straight away.
         """
 
         print(core.dt() + "Parsing article: " + url)
         # If the URL is for media content, return an empty dict
-        if url.endswith('.mp3') or url.endswith('.pdf'):
+        if self.is_media(url):
             return {}
         # Attempt to retrieve the URL
-        try:
+        if response is None:
             response = self.parse_url(url)
-        except:
-            raise
         # Record the parse time and remove decimal places
         parse_time = int(time.time())
-        # Use BeautifulSoup to parse the web page
-        soup = BeautifulSoup(response.content, 'lxml')
-        # Find all <meta> tags in the web page
-        metatags = soup.findAll('meta')
-        # Create an empty dict for the metadata
-        meta = {}
-        # Store Open Graph and Twitter metadata
-        for m in metatags:
-            for attr in ['property', 'name']:
-                if m.has_attr(attr):
-                    meta[m[attr]] = m['content']
-                    # If the meta value is an image
-                    for ext in ['.jpg', '.jpeg', '.gif', '.png',
-                        '.bmp', '.tiff']:
-                        if re.search(ext, m['content'].lower()) is not None:
-                            # Try and store it in the Object Store, and
-                            # replace the link with our own one
-                            try:
-                                meta[m[attr]] = self.obj.store(m['content'])
-                            #!! Improve exception handling !!
-                            except:
-                                pass
-        try:
-            meta = self.split_namespace(meta)
-        except Exception as e:
-            print(str(e))
-        # Store other metadata
-        if soup.find('title') is not None:
-            meta['title'] = soup.find('title').string
-        # Create a new dict for the article
-        article = {'meta': meta}
-        # Store full HTML document
-        html = response.content.decode(response.encoding)
-        article['html'] = html
-        ### Store article content
-        # Try to narrow down the soup
-        if soup.find('article') is not None:
-            soup_small = soup.find('article')
-        elif soup.find('body') is not None:
-            soup_small = soup.find('body')
+        # Extract the metadata and text
+        found = set()
+        article = extract.parse_html(response.content, found)
+        if media is not None:
+            media.update(found)
         else:
-            soup_small = soup
-        # Remove irrelevant elements
-        for e in soup_small(['head', 'header', 'nav', 'aside', 'footer',
-                             'script', 'noscript', 'style', 'meta', 'button',
-                             'source', 'img', 'path', 'svg', 'form', 'embed',
-                             'menu', 'iframe']):
-            e.extract()
-        # Get string
-        text = soup_small.get_text()
-        # Break into lines and remove leading and trailing space on each
-        lines = (line.strip() for line in text.splitlines())
-        # Break multi-headlines into a line each
-        chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-        # Drop blank lines
-        text = '\n'.join(chunk for chunk in chunks if chunk)
-        article['text'] = text
+            # Try and store the images in the Object Store, and replace
+            # the links with our own ones
+            stored = {}
+            for image_url in found:
+                try:
+                    stored[image_url] = self.obj.store(image_url)
+                #!! Improve exception handling !!
+                except:
+                    pass
+            replace_values(article['meta'], stored)
+        # Store full HTML document, compressed and outside of the doc
+        # body unless config.yaml says otherwise
+        html = response.content.decode(response.encoding)
+        article.update(htmlstore.pack(html, self.obj))
         # Store the crawl time
         article['crawl'] = {'time': str(parse_time)}
         return article
 
     def intuit_og(self, article):
-        """Construct an Open Graph object.
+        """Construct an Open Graph object. See ogp.intuit_og()."""
+        return ogp.intuit_og(article)
 
-        Args:
-            article (dict): Requires 'url' and 'outlet' as keys.
+    def reanalyse_article(self, url, dry_run=False):
+        """Parses the HTML stored in an article's CouchDB document
+        again and stores the result as a new revision. This keeps the
+        database consistent when modifications are made to this
+        class's source code. See reprocess for the whole archive.
 
         Returns:
-            dict:
-
-        Todo:
-            * If using an RSS description which contains HTML markup,
-                we should process the content using BeautifulSoup to
-                extract both text ('og:description') and an <img>
-                ('og:image') if one exists.
-            * Support the following properties:
-                og:type, og:audio, og:video
-            * Perhaps rename the method (infer, deduce, interpet)
+            bool: True if the article changed.
         """
-
-        def process(ogp, article, path, lists):
-            """
-
-            Todo:
-                * This could become a more standard method in the
-                    project because it allows us to create structured
-                    data from semi-structured data.
-            """
-            if traverse(ogp, [path]) is None:
-                value = traverse(article, lists)
-                if value is not None:
-                    for key in reversed(path):
-                        value = {key: value}
-                    ogp = self.merge(ogp, value)
-            return ogp
-
-        def traverse(article, lists):
-            """
-
-            Args:
-                lists (list): This should be a list of lists.
-
-            Returns:
-
-            """
-            for path in lists:
-                tmp = article.copy()
-                try:
-                    for key in path:
-                        tmp = tmp[key]
-                    return tmp
-                except KeyError:
-                    pass
-            return None
-
-        ogp = {'wa': {'outlet': article['outlet']}}
-        if 'meta' in article:
-            for key in ['og', 'article', 'music', 'video', 'book', 'profile']:
-                if key in article['meta']:
-                    ogp[key] = article['meta'][key]
-
-        if 'og' not in ogp:
-            ogp['og'] = {}
-        ogp['og']['url'] = article['url']
-        ogp = process(ogp=ogp, article=article,
-            path=['og', 'title'],
-            lists=[
-                ['meta', 'twitter', 'title'],
-                ['rss', 'item', 'title'],
-                ['meta', 'title']
-            ])
-        ogp = process(ogp=ogp, article=article,
-            path=['og', 'image'],
-            lists=[
-                ['meta', 'twitter', 'image'],
-                ['rss', 'channel', 'image']
-            ])
-        ogp = process(ogp=ogp, article=article,
-            path=['og', 'description'],
-            lists=[
-                ['meta', 'twitter', 'description'],
-                ['meta', 'description'],
-                ['rss', 'item', 'description']
-            ])
-        if 'og' in ogp:
-            if 'description' not in ogp['og']:
-                try:
-                    desc_soup = BeautifulSoup(
-                        article['rss']['item']['description'],
-                        'lxml'
-                    )
-                    #kill formatting
-                except KeyError:
-                    pass
-        ogp = process(ogp=ogp, article=article,
-            path=['og', 'site_name'],
-            lists=[
-                ['rss', 'channel', 'title']
-            ])
-        ogp = process(ogp=ogp, article=article,
-            path=['article', 'published_time'],
-            lists=[
-                ['rss', 'item', 'pubDate'],
-                ['rss', 'item', 'dc', 'date']
-            ])
-        ogp = process(ogp=ogp, article=article,
-            path=['article', 'modified_time'],
-            lists=[
-                ['meta', 'og', 'updated_time'],
-                ['sitemap', 'lastmod']
-            ])
-        # wa:publish_time
-        if 'article' in ogp:
-            if 'published_time' in ogp['article']:
-                publish_time = core.get_time(ogp['article']['published_time'])
-                ogp['wa']['publish_time'] = publish_time
-            elif 'modified_time' in ogp['article']:
-                publish_time = core.get_time(ogp['article']['modified_time'])
-                ogp['wa']['publish_time'] = publish_time
-        ogp = process(ogp=ogp, article=article,
-            path=['article', 'author'],
-            lists=[
-                ['meta', 'article', 'author'],
-                ['rss', 'item', 'dc', 'creator']
-            ])
-        try:
-            author = ogp['article']['author']
-            if isinstance(author, str):
-                ogp['article']['author'] = {'username': author}
-        except KeyError:
-            pass
-        # article:section - string - A high-level section name. E.g. Technology
-        # article:tag - string array
-        ogp = process(ogp=ogp, article=article,
-            path=['article', 'tag'],
-            lists=[
-                ['rss', 'item', 'category'],
-                ['meta', 'keywords']
-            ])
         try:
-            tag = ogp['article']['tag']
-            if isinstance(tag, str):
-                tag = tag.split(',')
-                for i in range(0, len(tag)):
-                    tag[i] = tag[i].strip()
-                ogp['article']['tag'] = tag
-            elif isinstance(tag, dict):
-                if 'content' in tag:
-                    ogp['article']['tag'] = [tag['content']]
-                else:
-                    ogp['article']['tag'] = list(tag)
-            elif isinstance(tag, list):
-                for i in range(0, len(tag)):
-                    if isinstance(tag[i], dict):
-                        if 'content' in tag[i]:
-                            ogp['article']['tag'][i] = tag[i]['content']
-        except KeyError:
-            pass
-        # Return the dict
-        return ogp
-
-    def reanalyse_article(self, url):
-        """Future method. This method should take the HTML stored in
-        the CouchDB document, reanalyse it and store it as a new
-        revision. This method will be used to ensure database
-        consistency when modifications are made to this classes source
-        code.
-        """
-        try:
-            article = self.db_articles._db.get(url)
-            soup = BeautifulSoup(article['html'], 'lxml')
-            #do stuff
-            self.db_articles.store_article(article)
-        except:
-            pass
-        return None
+            article = dict(self.db_articles._db.get(url))
+            reprocessor = Reprocessor(self.db_articles, obj=self.obj,
+                                      reparse=True, dry_run=dry_run,
+                                      workers=0)
+            return reprocessor.reprocess([article]) > 0
+        except Exception as e:
+            print(core.dt() + "Failed to reanalyse article: " + str(e))
+        return False
 
     def split_namespace(self, old_dict):
         """Takes a dict and if the key has a colon, then create a
-        subdict.
+        subdict. See core.split_namespace().
         """
-        new_dict = {}
-
-        for key in old_dict:
-            # Turn it into a nested dict
-            tmp = old_dict[key]
-            split_key = key.split(':')
-            for s in reversed(split_key):
-                tmp = {s: tmp}
-            # Merge it into the main dict
-            new_dict = self.merge(new_dict, tmp)
-
-        return new_dict
+        return core.split_namespace(old_dict)
 
     def merge(self, a, b, path=None):
-        """merges dict b into a
+        """merges dict b into a. See core.merge().
         """
-        if path is None:
-            path = []
-        for key in b:
-            if key in a:
-                if isinstance(a[key], dict) and isinstance(b[key], dict):
-                    self.merge(a[key], b[key], path + [str(key)])
-                # If we are inserting a key/value into a key/dict
-                elif isinstance(a[key], dict) and not isinstance(b[key], dict):
-                    tmp = b[key]
-                    b[key] = {'content': tmp}
-                    self.merge(a[key], b[key], path + [str(key)])
-                # If we are inserting a key/dict into a key/value
-                elif not isinstance(a[key], dict) and isinstance(b[key], dict):
-                    tmp = a[key]
-                    a[key] = {'content': tmp}
-                    self.merge(a[key], b[key], path + [str(key)])
-                # Same leaf value
-                elif a[key] == b[key]:
-                    pass
-                else:
-                    #raise Exception('Conflict at %s' % '.'.join(path + [str(key)]))
-                    pass
-            else:
-                a[key] = b[key]
-        return a
+        return core.merge(a, b, path)
 
-    def iterate(self, outlet=None):
-        """"""
+    def iterate(self, outlet=None, feeds=None):
+        """Crawls XML sitemaps and RSS feeds and archives the new
+        articles they list.
+
+        Args:
+            outlet (str): Only crawl this outlet's feeds.
+            feeds (list): Only crawl these feed URLs.
+
+        Returns:
+            dict: Each crawled feed URL and a dict of 'new', the number
+                of new articles it listed, and 'published', the publish
+                times of every article it listed.
+        """
         # Retrieve a dict of XML sitemaps and RSS feeds
         urls = self.db_outlets.get_crawler()
-        # Create a list of articles that are currently stored in the db
-        self.articles_list = {}
-        articles = self.db_articles.get_articles_list()
-        for a in articles:
-            self.articles_list.update(a)
+        # Catch up with the articles stored since the last cycle
+        self.article_index.refresh()
 
         # If an outlet is passed as an argument, then isolate the
         # relevant URLs
@@ -577,64 +388,175 @@ class OGHarvester():
             for u in list(urls):
                 if (urls[u] != outlet):
                     urls.pop(u, None)
+        # If a list of feeds is passed as an argument, then isolate
+        # those URLs
+        if feeds is not None:
+            urls = {u: urls[u] for u in feeds if u in urls}
 
         articles = {}
+        stats = {}
+        # The new articles and the feeds (a sitemap index and the
+        # sitemaps it lists) read for each aggregator
+        listed = {}
+        read = {}
         # Discover new content from aggregators
         for u in urls:
             count = 0
-            new_articles = {}
-            new_articles = self.parse_aggregator(u)
+            published = []
+            listed[u] = set()
+            before = set(self.new_validators)
             # Detect which articles we already have archived and
-            # add the new ones to the master list
-            for n in new_articles:
-                new_articles[n]['outlet'] = urls[u]
-                if n not in self.articles_list:
+            # add the new ones to the master list as the aggregator
+            # is parsed
+            for new_article in self.parse_aggregator(u):
+                n = new_article['url']
+                new_article['outlet'] = urls[u]
+                publish_time = self.publish_time(new_article)
+                if publish_time is not None:
+                    published.append(publish_time)
+                if n not in self.article_index:
                     if n not in articles:
                         articles[n] = {}
-                    articles[n].update(new_articles[n])
+                    articles[n].update(new_article)
+                    listed[u].add(n)
                     count += 1
+            read[u] = set(self.new_validators) - before
             print(str(count) + " new articles found.")
+            stats[u] = {'new': count, 'published': published}
 
-        # Call list() to make a copy of articles.keys() since the dict
-        # size will change during iteration
+        # Fetch the articles concurrently and parse them as they
+        # arrive. Call list() to make a copy of articles.keys() since
+        # the dict size will change during iteration
         count = 0
-        for a in list(articles):
+        for a, response, error in self.fetch_articles(list(articles)):
+            if error is not None:
+                print(core.dt() + "Failed to parse article: " + str(error))
+                continue
             try:
-                # Parse the article
-                articles[a].update(self.parse_article(a))
+                # Parse the article. Its images are stored after the
+                # article, in the background.
+                media = set()
+                articles[a].update(self.parse_article(a, response, media))
                 # Intuit the open graph properties
                 articles[a]['ogp'] = self.intuit_og(articles[a])
                 # Attempt to store it in the database. Pop the article
-                # from the dict to reduce memory usage.
+                # from the dict to reduce memory usage. It is indexed
+                # and its images are queued once it has been written.
                 try:
-                    self.db_articles.store_article(articles.pop(a))
+                    self.db_articles.store_article(
+                        articles.pop(a),
+                        on_stored=functools.partial(self.article_stored,
+                                                    a, media)
+                    )
                     count += 1
                 except:
                     pass
             except Exception as e:
                 print(core.dt() + "Failed to parse article: " + str(e))
                 pass
+        # Write any articles left in the buffer, which queues their
+        # images, then wait for the images to be stored and patched
+        # into the articles
+        self.db_articles.flush()
+        self.media.wait()
+        # Only record the validators of an aggregator once every new
+        # article it listed is stored. Otherwise it would answer 304
+        # next time and the missing articles would never be listed
+        # again.
+        for u in urls:
+            if all(n in self.article_index for n in listed[u]):
+                for feed_url in read[u]:
+                    validators = self.new_validators[feed_url]
+                    if feed_url in self.sitemap_indexes:
+                        validators['sitemaps'] = (
+                            self.sitemap_indexes[feed_url]
+                        )
+                    self.update_feed_state(feed_url, validators)
+        self.new_validators.clear()
+        self.db_crawler.flush()
 
         print(core.dt() + "Successfully archived " + str(count) + " new articles.\n")
+        return stats
 
-    def parse_aggregator(self, url):
-        articles = {}
+    def article_stored(self, url, media, response):
+        """Called once an article has been written to the database.
+        Adds it to the index and queues its images to be stored.
+        """
+        self.article_index.add(url)
+        self.media.submit(url, media)
+
+    def publish_time(self, article):
+        """Returns the UNIX timestamp an aggregator lists for an
+        article (RSS pubDate or sitemap lastmod), or None.
+        """
         try:
-            response = self.parse_url(url)
-            soup = BeautifulSoup(response.content, 'xml')
-            if soup.find('urlset') is not None:
-                articles = self.parse_sitemap(url)
-            elif soup.find('rss') is not None:
-                articles = self.parse_rss(url)
-            elif soup.find('rdf') is not None:
-                articles = self.parse_rss(url)
-            elif soup.find('RDF') is not None:
-                articles = self.parse_rss(url)
+            if 'rss' in article:
+                return article['rss']['item'].get('pubDate_time')
+            if 'sitemap' in article:
+                return article['sitemap'].get('lastmod_time')
+        except AttributeError:
+            pass
+        return None
+
+    def run(self, max_sleep=300):
+        """Polls each feed whenever the scheduler says it is due.
+        Never returns.
+
+        Args:
+            max_sleep (int/float): The maximum number of seconds to
+                sleep before checking the outlets database for feeds
+                that have been added or removed.
+        """
+        while True:
+            # Pick up feeds added to or removed from the outlets
+            self.scheduler.sync(self.db_outlets.get_crawler())
+            due = self.scheduler.due()
+            if due:
+                poll_time = time.time()
+                stats = {}
+                try:
+                    stats = self.iterate(feeds=due)
+                finally:
+                    # Learn each feed's publish rate and reschedule it.
+                    # The feeds have been taken off the schedule, so
+                    # this happens even if the crawl failed, or they
+                    # would never be polled again.
+                    for url in due:
+                        feed_stats = stats.get(url, {})
+                        schedule = self.scheduler.record(
+                            url,
+                            feed_stats.get('new', 0),
+                            feed_stats.get('published', ()),
+                            now=poll_time
+                        )
+                        print(
+                            core.dt()
+                            + "Next poll of "
+                            + url
+                            + " in "
+                            + str(int(schedule['interval']))
+                            + " seconds."
+                        )
+                        self.db_crawler.store_feed_state(
+                            self.feed_states[url]
+                        )
+                    self.db_crawler.flush()
+            next_poll = self.scheduler.next_poll()
+            if next_poll is None:
+                seconds = max_sleep
             else:
-                print(core.dt() + "No schema detected for: " + url)
-        except Exception as e:
-            print(str(e))
-        return articles
+                seconds = max(0, min(next_poll - time.time(), max_sleep))
+            if seconds > 0:
+                print(core.dt() + "Sleeping for " + str(int(seconds)) + " seconds.")
+                time.sleep(seconds)
+
+    def parse_aggregator(self, url):
+        """Yields the articles in an XML sitemap or RSS feed. The
+        schema is detected from the root element of the document.
+        """
+        print(core.dt() + "Crawling " + url + ". ", end="")
+        for article in self.iter_feed(url):
+            yield article
 
     def parse_web_archive(self):
         urls = {}
@@ -643,7 +565,7 @@ class OGHarvester():
         }
 
         for wb in wbs:
-            response = requests.get(wb)
+            response = web.get(wb)
             soup = BeautifulSoup(response.content, 'lxml')
             links = soup.findAll('a')
 
@@ -658,43 +580,31 @@ class OGHarvester():
             time.sleep(2)
         return urls
 
-    def reform_ogp(self, outlet=None):
-        # Create a list of articles that are currently stored in the db
-        self.articles_list = {}
-        articles = self.db_articles.get_articles_list()
-        for a in articles:
-            for url in a:
-                if outlet is not None:
-                    if (a[url]['outlet'] == outlet):
-                        self.articles_list.update(a)
-                else:
-                    self.articles_list.update(a)
+    def reform_ogp(self, outlet=None, dry_run=False, checkpoint=None):
+        """Intuits the Open Graph object of every archived article
+        again. See reprocess.Reprocessor.
 
-        count = 0
-        for url in self.articles_list:
-            count += 1
-            article = dict(self.db_articles._db.get(url))
-            if 'manual' not in article['ogp']:
-                print(str(count) + ": Parsing url: " + url)
-                try:
-                    ogp = self.intuit_og(article)
-                    article['ogp'] = ogp
-                    self.db_articles.store_article(article)
-                except:
-                    print('something fucked up')
+        Args:
+            outlet (str): Only reform this outlet's articles.
+            dry_run (bool): True to print the changes rather than
+                store them.
+            checkpoint (str): A checkpoint file to resume from.
+        """
+        reprocessor = Reprocessor(self.db_articles, outlet=outlet,
+                                  dry_run=dry_run, checkpoint=checkpoint)
+        return reprocessor.run()
 
 ##################
 ## Main Program ##
 ##################
 
-og_harvester = OGHarvester()
-while True:
-    og_harvester.iterate()
-    minutes = 5;
-    print(core.dt() + "Sleeping for " + str(minutes) + " minutes.")
-    time.sleep(minutes*60)
+if __name__ == '__main__':
+    # Re-read config.yaml on SIGHUP
+    core.install_reload_handler()
+    og_harvester = OGHarvester()
+    og_harvester.run()
 
-#og_harvester.reform_ogp()
+    #og_harvester.reform_ogp()
 
-#articles = og_harvester.parse_rss('https://www.buzzfeed.com/allanclarke.xml')
-#print(articles)
+    #articles = og_harvester.parse_rss('https://www.buzzfeed.com/allanclarke.xml')
+    #print(articles)
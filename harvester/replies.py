@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+"""replies
+
+An index of the tweets that stored tweets reply to but that aren't in
+the database yet, so that TweetHarvester.iterate_replies() can work
+through them without scanning every tweet again.
+"""
+
+import time
+import threading
+
+import core
+
+# The name of the _local doc recording that the index has been seeded
+SEEDED = 'seeded'
+
+
+class PendingReplies():
+    """The replies waiting to be downloaded.
+
+    Each pending reply is a doc in its own database. Its _id is the
+    status that was replied to, and it records the reply and the reply's
+    user, as returned by CouchDBComms.get_replies_full(). The index is
+    kept up to date as tweets are stored (see stored()): a stored reply
+    adds its status if it isn't in the database, and a stored tweet
+    resolves the reply pending for it.
+
+    Stored tweets are buffered and applied with a handful of bulk
+    requests every batch tweets, or when flush() is called.
+    """
+
+    def __init__(self, db, db_tweets, db_archive=None, batch=100):
+        """
+        Args:
+            db (CouchDBComms): The database of pending replies.
+            db_tweets (CouchDBComms): The database of tweets.
+            db_archive (CouchDBComms): The database of archived tweets,
+                if there is one. Statuses stored in either database
+                aren't pending.
+            batch (int): The number of stored tweets to buffer before
+                they are applied to the index.
+        """
+        self.db = db
+        self.db_tweets = db_tweets
+        self.dbs_stored = [d for d in (db_tweets, db_archive)
+                           if d is not None]
+        self.batch = batch
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._seeded = False
+
+    def seed(self):
+        """Fills the index from the tweets/replies_full view the first
+        time it is used. This scans the whole tweets database, so it
+        only happens once per database. The replies are written batch
+        at a time, leaving out any that are already pending.
+        """
+        if self._seeded:
+            return
+        if self.db.get_local(SEEDED) is None:
+            replies = list(self.db_tweets.get_replies_full().items())
+            count = 0
+            for i in range(0, len(replies), self.batch):
+                page = replies[i:i + self.batch]
+                pending = self.db.get_revs([r[0] for r in page])
+                new = [
+                    self._pending(status_id, reply.get('reply'),
+                                  reply.get('reply_user'))
+                    for status_id, reply in page
+                    if status_id not in pending
+                ]
+                if new:
+                    self.db.store_dicts(new)
+                count += len(new)
+            self.db.store_local(SEEDED, {'time': str(int(time.time()))})
+            print(
+                core.dt()
+                + "Seeded the index with "
+                + str(count)
+                + " pending replies."
+            )
+        self._seeded = True
+
+    def _stored_ids(self, ids):
+        """Returns the IDs of the statuses stored in any of the tweet
+        databases.
+        """
+        stored = set()
+        for db in self.dbs_stored:
+            stored.update(db.get_revs([i for i in ids if i not in stored]))
+        return stored
+
+    def _pending(self, status_id, reply, reply_user):
+        return {'_id': status_id,
+                'reply': reply,
+                'reply_user': reply_user}
+
+    def stored(self, tweet):
+        """Records that a tweet has been stored.
+
+        Args:
+            tweet (dict): The tweet.
+        """
+        with self._lock:
+            self._buffer.append(tweet)
+            full = len(self._buffer) >= self.batch
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Applies the buffered tweets to the index. Replies to tweets
+        that aren't stored are added and the replies pending for the
+        stored tweets are resolved.
+
+        The index is seeded first, if it hasn't been. The tweet
+        databases' write buffers are flushed, so that tweets waiting in
+        them are counted as stored (and are themselves applied).
+        """
+        self.seed()
+        for db in self.dbs_stored:
+            db.flush()
+        with self._lock:
+            tweets = self._buffer
+            self._buffer = []
+        if not tweets:
+            return
+        stored = set()
+        replies = {}
+        for tweet in tweets:
+            stored.add(tweet['id_str'])
+            status_id = tweet.get('in_reply_to_status_id_str')
+            if (tweet.get('in_reply_to_user_id_str') is not None
+                    and status_id is not None):
+                replies[status_id] = self._pending(
+                    status_id, tweet['id_str'], tweet['user']['id_str']
+                )
+        for status_id in stored:
+            replies.pop(status_id, None)
+        # Leave out the replies that are already pending or stored
+        pending = self.db.get_revs(list(stored | set(replies)))
+        for status_id in self._stored_ids(list(replies)):
+            replies.pop(status_id, None)
+        new = [r for status_id, r in replies.items()
+               if status_id not in pending]
+        if new:
+            self.db.store_dicts(new)
+        resolved = {_id: rev for _id, rev in pending.items()
+                    if _id in stored}
+        if resolved:
+            self.db.delete_docs(resolved)
+
+    def iterate(self, batch=100):
+        """Yields the pending replies a page at a time.
+
+        Replies whose status has been stored since they were added are
+        resolved rather than yielded.
+
+        Yields:
+            list: dicts with the status '_id', 'reply' and 'reply_user'.
+        """
+        self.flush()
+        page = []
+        for doc in self.db.iter_docs(batch=batch):
+            page.append(doc)
+            if len(page) >= batch:
+                page = self._outstanding(page)
+                if page:
+                    yield page
+                page = []
+        page = self._outstanding(page)
+        if page:
+            yield page
+
+    def _outstanding(self, page):
+        stored = self._stored_ids([doc['_id'] for doc in page])
+        if stored:
+            self.db.delete_docs({
+                doc['_id']: doc['_rev'] for doc in page
+                if doc['_id'] in stored
+            })
+        return [doc for doc in page if doc['_id'] not in stored]
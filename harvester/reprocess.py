@@ -0,0 +1,315 @@
+#!/usr/bin/python3
+"""reprocess
+
+Re-derives the fields of archived articles after the parsers change.
+
+Articles are streamed from _all_docs a page at a time. The Open Graph
+object of each one is intuited again (see ogp.intuit_og()) and,
+optionally, its stored HTML is parsed again (see extract.parse_html()).
+The CPU-bound work runs on a process pool and each page of changed
+articles is written back with one _bulk_docs request. After each page
+the last _id is written to a checkpoint file, so an interrupted run
+carries on from where it stopped. A dry run prints what would change
+without writing anything.
+
+Usage:
+    python3 reprocess.py [--reparse] [--dry-run] [--outlet OUTLET]
+        [--checkpoint FILE] [--workers N] [--batch N]
+"""
+
+import os
+import copy
+import json
+import argparse
+from multiprocessing import Pool
+
+import core
+import extract
+import htmlstore
+import ogp
+from media import replace_values
+
+# The longest value printed in a dry run diff
+MAX_DIFF_VALUE = 80
+
+
+def rederive(doc, html=None):
+    """Returns a copy of an article doc with its derived fields
+    derived again.
+
+    Args:
+        doc (dict): The article doc.
+        html (str): The article's HTML. If passed, 'meta' and 'text'
+            are extracted from it again.
+
+    Returns:
+        tuple: The new doc and a list of the image URLs found in the
+            meta tags, which still need replacing with their Object
+            Store URLs.
+    """
+    new_doc = copy.deepcopy(doc)
+    media = set()
+    if html is not None:
+        new_doc.update(extract.parse_html(html, media))
+    new_doc['ogp'] = ogp.intuit_og(new_doc)
+    return new_doc, sorted(media)
+
+
+def _rederive(task):
+    # Unpack the arguments for Pool.imap()
+    return rederive(*task)
+
+
+def diff(old, new, path=()):
+    """Yields (path, old value, new value) for each value that differs
+    between two docs. Missing values are None.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in sorted(set(old) | set(new), key=str):
+            for d in diff(old.get(key), new.get(key), path + (key,)):
+                yield d
+    elif old != new:
+        yield path, old, new
+
+
+def _short(value):
+    value = repr(value)
+    if len(value) > MAX_DIFF_VALUE:
+        value = value[:MAX_DIFF_VALUE - 3] + '...'
+    return value
+
+
+class Reprocessor():
+    """Re-derives articles in bulk. See the module docstring."""
+
+    def __init__(self, db, obj=None, reparse=False, dry_run=False,
+                 outlet=None, workers=None, batch=500, checkpoint=None):
+        """
+        Args:
+            db (CouchDBComms): The database of articles.
+            obj (ObjectStore): Used to look up (and if necessary store)
+                the images found when HTML is parsed again. Without it
+                the original image URLs are kept.
+            reparse (bool): True to parse the stored HTML again.
+            dry_run (bool): True to print the changes rather than
+                write them.
+            outlet (str): Only reprocess this outlet's articles.
+            workers (int): The number of worker processes. Defaults to
+                the number of CPUs. 0 reprocesses in this process.
+            batch (int): The number of articles per page.
+            checkpoint (str): The checkpoint file, if the run should be
+                resumable.
+        """
+        self.db = db
+        self.obj = obj
+        self.reparse = reparse
+        self.dry_run = dry_run
+        self.outlet = outlet
+        self.workers = workers
+        self.batch = batch
+        self.checkpoint = checkpoint
+
+    def _load_checkpoint(self):
+        if self.checkpoint is None or not os.path.exists(self.checkpoint):
+            return {}
+        with open(self.checkpoint) as f:
+            return json.load(f)
+
+    def _save_checkpoint(self, state):
+        # Write to a temporary file and rename it, so that the
+        # checkpoint is never left half written
+        tmp = self.checkpoint + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.checkpoint)
+
+    def _wanted(self, doc):
+        """Returns True if a doc should be reprocessed."""
+        # Leave manually edited Open Graph objects alone
+        if 'manual' in doc.get('ogp', {}):
+            return False
+        if self.outlet is not None and doc.get('outlet') != self.outlet:
+            return False
+        return True
+
+    def _resolve_media(self, urls):
+        """Returns the Object Store URLs of images found by parsing HTML
+        again. A dry run only uses the media index, so nothing is
+        downloaded or uploaded.
+        """
+        stored = {}
+        if self.obj is None:
+            return stored
+        for url in urls:
+            try:
+                if self.dry_run:
+                    md5 = self.obj.index.get_md5(self.obj.bucket_name, url)
+                    if md5 is not None:
+                        stored[url] = self.obj.object_url(md5)
+                else:
+                    stored[url] = self.obj.store(url)
+            except Exception as e:
+                print(
+                    core.dt()
+                    + "Warning: Could not store media "
+                    + url
+                    + ": "
+                    + str(e)
+                )
+        return stored
+
+    def _tasks(self, docs):
+        for doc in docs:
+            html = None
+            if self.reparse:
+                try:
+                    html = htmlstore.get_html(self.db, doc)
+                except Exception as e:
+                    print(
+                        core.dt()
+                        + "Warning: Could not read the HTML of "
+                        + doc['_id']
+                        + ": "
+                        + str(e)
+                    )
+            yield doc, html
+
+    def reprocess(self, docs, pool=None):
+        """Re-derives a list of docs and writes back the ones that
+        changed (or prints them, in a dry run).
+
+        Returns:
+            int: The number of docs that changed.
+        """
+        tasks = list(self._tasks(docs))
+        if pool is not None:
+            results = pool.imap(_rederive, tasks, chunksize=16)
+        else:
+            results = map(_rederive, tasks)
+        changed = []
+        for (doc, html), (new_doc, media) in zip(tasks, results):
+            if media:
+                stored = self._resolve_media(media)
+                for field in ('meta', 'ogp'):
+                    if field in new_doc:
+                        replace_values(new_doc[field], stored)
+            if new_doc == doc:
+                continue
+            changed.append(new_doc)
+            if self.dry_run:
+                for path, old, new in diff(doc, new_doc):
+                    print(
+                        doc['_id']
+                        + ": "
+                        + '.'.join(str(p) for p in path)
+                        + ": "
+                        + _short(old)
+                        + " -> "
+                        + _short(new)
+                    )
+        if changed and not self.dry_run:
+            self.db.store_dicts(changed)
+        return len(changed)
+
+    def run(self):
+        """Reprocesses every article, starting after the checkpoint if
+        there is one.
+
+        Returns:
+            dict: The number of docs 'processed' and 'changed'.
+        """
+        state = self._load_checkpoint()
+        last_id = state.get('last_id')
+        totals = {
+            'processed': state.get('processed', 0),
+            'changed': state.get('changed', 0)
+        }
+        if last_id is not None:
+            print(core.dt() + "Resuming after " + last_id + ".")
+        pool = None
+        if self.workers != 0:
+            pool = Pool(self.workers)
+        try:
+            page = []
+            for doc in self.db.iter_docs(startkey=last_id, batch=self.batch):
+                # startkey is inclusive
+                if doc['_id'] == last_id:
+                    continue
+                page.append(doc)
+                if len(page) >= self.batch:
+                    self._run_page(page, pool, totals)
+                    page = []
+            if page:
+                self._run_page(page, pool, totals)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        print(
+            core.dt()
+            + "Reprocessed "
+            + str(totals['processed'])
+            + " articles, "
+            + str(totals['changed'])
+            + " changed."
+        )
+        return totals
+
+    def _run_page(self, page, pool, totals):
+        docs = [doc for doc in page if self._wanted(doc)]
+        totals['processed'] += len(docs)
+        totals['changed'] += self.reprocess(docs, pool)
+        if self.checkpoint is not None and not self.dry_run:
+            state = dict(totals)
+            state['last_id'] = page[-1]['_id']
+            self._save_checkpoint(state)
+        print(
+            core.dt()
+            + "Reprocessed up to "
+            + page[-1]['_id']
+            + " ("
+            + str(totals['processed'])
+            + " articles, "
+            + str(totals['changed'])
+            + " changed)."
+        )
+
+
+##################
+## Main Program ##
+##################
+
+if __name__ == '__main__':
+    from comms.couchdb import CouchDBComms as db
+    from comms.nectar import ObjectStore
+
+    parser = argparse.ArgumentParser(
+        description='Re-derive the fields of archived articles.'
+    )
+    parser.add_argument('--reparse', action='store_true',
+                        help='Parse the stored HTML again.')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Print the changes instead of writing them.')
+    parser.add_argument('--outlet', help='Only reprocess this outlet.')
+    parser.add_argument('--checkpoint',
+                        help='Resume from and record progress in FILE.')
+    parser.add_argument('--workers', type=int,
+                        help='The number of worker processes.')
+    parser.add_argument('--batch', type=int, default=500,
+                        help='The number of articles per page.')
+    args, unknown = parser.parse_known_args()
+
+    obj = None
+    if args.reparse:
+        obj = ObjectStore('wa-opengraph')
+    reprocessor = Reprocessor(
+        db('articles'),
+        obj=obj,
+        reparse=args.reparse,
+        dry_run=args.dry_run,
+        outlet=args.outlet,
+        workers=args.workers,
+        batch=args.batch,
+        checkpoint=args.checkpoint
+    )
+    reprocessor.run()
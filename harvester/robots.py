@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+"""robots
+
+A cache of robots.txt rules, so that a host's robots.txt is downloaded
+once rather than before every page we crawl on that host.
+"""
+
+import re
+import time
+import threading
+from collections import OrderedDict
+from urllib import robotparser
+from urllib.parse import urlsplit
+
+import core
+from comms import web
+
+_MAX_AGE_RE = re.compile(r'max-age\s*=\s*"?(\d+)')
+
+
+class RobotsCache():
+    """robots.txt rules keyed by scheme and host.
+
+    Rules are kept for the max-age given in the robots.txt response's
+    Cache-Control header (at most max_ttl, RFC 9309 asks crawlers not
+    to cache robots.txt for more than 24 hours), or for default_ttl if
+    there is no max-age. The least recently used hosts are evicted once
+    more than max_hosts are cached.
+
+    As in RFC 9309, a 4xx response means that there are no rules and
+    crawling is allowed, while a 5xx response or a network error means
+    that crawling is disallowed. Failures are cached for error_ttl
+    seconds so that they are retried sooner.
+    """
+
+    def __init__(self, user_agent='*', max_hosts=1024, default_ttl=86400,
+                 max_ttl=86400, min_ttl=60, error_ttl=600):
+        """"""
+        self.user_agent = user_agent
+        self.max_hosts = max_hosts
+        self.default_ttl = default_ttl
+        self.max_ttl = max_ttl
+        self.min_ttl = min_ttl
+        self.error_ttl = error_ttl
+        # base URL -> (expiry time, RobotFileParser)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def can_fetch(self, url):
+        """Returns True if robots.txt allows us to crawl the URL."""
+        base_url = '{0.scheme}://{0.netloc}/'.format(urlsplit(url))
+        return self.get(base_url).can_fetch(self.user_agent, url)
+
+    def get(self, base_url):
+        """Returns the RobotFileParser for a base URL, downloading the
+        robots.txt file if it isn't cached or has expired.
+        """
+        with self._lock:
+            entry = self._cache.get(base_url)
+            if entry is not None and entry[0] > time.time():
+                self._cache.move_to_end(base_url)
+                return entry[1]
+        # Download outside of the lock so that other hosts aren't
+        # blocked by a slow server
+        rp, ttl = self._fetch(base_url)
+        with self._lock:
+            self._cache[base_url] = (time.time() + ttl, rp)
+            self._cache.move_to_end(base_url)
+            while len(self._cache) > self.max_hosts:
+                self._cache.popitem(last=False)
+        return rp
+
+    def _fetch(self, base_url):
+        """Downloads and parses a robots.txt file.
+
+        Returns:
+            tuple: The RobotFileParser and the number of seconds it can
+                be cached for.
+        """
+        rp = robotparser.RobotFileParser()
+        rp.set_url(base_url + 'robots.txt')
+        try:
+            response = web.get(base_url + 'robots.txt')
+        except Exception as e:
+            print(
+                core.dt()
+                + "Warning: Could not retrieve "
+                + base_url
+                + "robots.txt, disallowing access: "
+                + str(e)
+            )
+            rp.disallow_all = True
+            return rp, self.error_ttl
+        if response.status_code >= 500:
+            rp.disallow_all = True
+            return rp, self.error_ttl
+        if response.status_code >= 400:
+            rp.allow_all = True
+        else:
+            rp.parse(response.text.splitlines())
+        return rp, self._ttl(response)
+
+    def _ttl(self, response):
+        """Returns the number of seconds a robots.txt response can be
+        cached for, based on its Cache-Control header.
+        """
+        match = _MAX_AGE_RE.search(response.headers.get('Cache-Control', ''))
+        if match is None:
+            return self.default_ttl
+        return max(self.min_ttl, min(int(match.group(1)), self.max_ttl))
@@ -0,0 +1,198 @@
+#!/usr/bin/python3
+"""scheduler
+
+Decides when each sitemap and RSS feed should next be polled.
+
+Every feed has its own polling interval, learnt from how quickly it
+publishes. The publish rate is an exponentially weighted moving average
+of the new articles found per second, combined with the gaps between
+the pubDate/lastmod times listed in the feed. The next poll is timed for
+when about one new article is expected, within min_interval and
+max_interval, and the interval at most doubles from one poll to the
+next. Feeds wait on a priority queue ordered by the time they
+are next due. Settings can be overridden in the optional 'scheduler'
+section of config.yaml:
+
+scheduler:
+  min_interval: 60
+  max_interval: 86400
+  default_interval: 300
+  alpha: 0.3
+"""
+
+import heapq
+import time
+
+import core
+
+DEFAULTS = {
+    'min_interval': 60,
+    'max_interval': 86400,
+    'default_interval': 300,
+    'alpha': 0.3
+}
+# The number of most recent publish times used to estimate a feed's
+# publish rate
+MAX_PUBLISH_TIMES = 20
+
+
+class FeedScheduler():
+    """A priority queue of feeds ordered by the time they are next due
+    to be polled.
+
+    The schedule of each feed is kept under 'schedule' in its crawl
+    state doc (see OGHarvester.feed_states), so that it survives a
+    restart once the doc has been stored.
+    """
+
+    def __init__(self, states, min_interval=None, max_interval=None,
+                 default_interval=None, alpha=None):
+        """
+        Args:
+            states (dict): Feed URLs and their crawl state docs. New
+                feeds are added to it.
+            min_interval (int/float): The minimum number of seconds
+                between two polls of a feed.
+            max_interval (int/float): The maximum number of seconds
+                between two polls of a feed.
+            default_interval (int/float): The interval used until a
+                feed's publish rate is known.
+            alpha (float): The weight of the newest observation in the
+                moving average of the publish rate, between 0 and 1.
+        """
+        args = dict(DEFAULTS)
+        args.update(core.config().get('scheduler', {}))
+        self.min_interval = float(min_interval or args['min_interval'])
+        self.max_interval = float(max_interval or args['max_interval'])
+        self.default_interval = float(
+            default_interval or args['default_interval']
+        )
+        self.alpha = float(alpha or args['alpha'])
+        self.states = states
+        # (next poll time, feed URL). Entries for feeds that have been
+        # rescheduled or removed are skipped when they are popped.
+        self._heap = []
+        self._feeds = set()
+
+    def sync(self, urls):
+        """Schedules new feeds and forgets feeds that are no longer
+        crawled. Feeds that have never been polled are due straight
+        away.
+
+        Args:
+            urls (iterable): Every feed URL that should be crawled.
+        """
+        urls = set(urls)
+        for url in urls - self._feeds:
+            state = self.states.setdefault(url, {'_id': url})
+            schedule = state.setdefault('schedule', {})
+            heapq.heappush(self._heap, (schedule.get('next_poll', 0), url))
+        self._feeds = urls
+
+    def next_poll(self):
+        """Returns the time the next feed is due, or None if there are
+        no feeds.
+        """
+        while self._heap:
+            next_poll, url = self._heap[0]
+            if self._is_current(next_poll, url):
+                return next_poll
+            heapq.heappop(self._heap)
+        return None
+
+    def due(self, now=None):
+        """Removes and returns the feeds that are due to be polled.
+        Each one is scheduled again by record().
+
+        Returns:
+            list: Feed URLs, the most overdue first.
+        """
+        if now is None:
+            now = time.time()
+        urls = []
+        while self._heap and self._heap[0][0] <= now:
+            next_poll, url = heapq.heappop(self._heap)
+            if self._is_current(next_poll, url):
+                urls.append(url)
+        return urls
+
+    def _is_current(self, next_poll, url):
+        if url not in self._feeds:
+            return False
+        return self.states[url]['schedule'].get('next_poll', 0) == next_poll
+
+    def record(self, url, new_articles, publish_times=(), now=None):
+        """Updates a feed's publish rate after it has been polled and
+        schedules its next poll.
+
+        Args:
+            url (str): The feed URL.
+            new_articles (int): The number of new articles found.
+            publish_times (iterable): UNIX timestamps of the articles
+                listed in the feed (pubDate or lastmod), new or not.
+            now (float): The time of the poll.
+
+        Returns:
+            dict: The feed's updated schedule.
+        """
+        if now is None:
+            now = time.time()
+        state = self.states.setdefault(url, {'_id': url})
+        schedule = state.setdefault('schedule', {})
+        samples = []
+        # New articles per second since the last poll
+        last_poll = schedule.get('last_poll')
+        if last_poll is not None and now > last_poll:
+            samples.append(new_articles / (now - last_poll))
+        # Articles per second between the publish times in the feed
+        published = self._publish_rate(publish_times, now)
+        if published is not None:
+            samples.append(published)
+        rate = schedule.get('rate')
+        if samples:
+            sample = sum(samples) / len(samples)
+            if rate is None:
+                rate = sample
+            else:
+                rate = self.alpha * sample + (1 - self.alpha) * rate
+        # Poll again when about one new article is expected
+        if rate is None:
+            interval = self.default_interval
+        elif rate > 0:
+            interval = 1 / rate
+        else:
+            interval = self.max_interval
+        # Back off gradually, at most doubling the interval each poll,
+        # so that one quiet spell doesn't park a feed for a day
+        previous = schedule.get('interval', self.default_interval)
+        interval = min(interval, 2 * previous)
+        interval = max(self.min_interval, min(interval, self.max_interval))
+        schedule.update({
+            'rate': rate,
+            'interval': interval,
+            'last_poll': now,
+            'next_poll': now + interval
+        })
+        if url in self._feeds:
+            heapq.heappush(self._heap, (schedule['next_poll'], url))
+        return schedule
+
+    def _publish_rate(self, publish_times, now):
+        """Returns the articles per second implied by the most recent
+        publish times, or None if there are fewer than two.
+        """
+        times = []
+        for t in publish_times:
+            try:
+                t = float(t)
+            except (TypeError, ValueError):
+                continue
+            # Ignore publish times in the future
+            if t <= now:
+                times.append(t)
+        times = sorted(set(times))[-MAX_PUBLISH_TIMES:]
+        if len(times) < 2:
+            return None
+        # Count the time since the newest article too, so that a feed
+        # which has gone quiet slows down
+        return (len(times) - 1) / (now - times[0])
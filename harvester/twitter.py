@@ -5,6 +5,8 @@ For harvesting tweets using the Twitter Search API.
 """
 
 import sys
+import copy
+import functools
 import time
 import math
 import json
@@ -16,6 +18,7 @@ import geocoder
 
 import core
 from comms.couchdb import CouchDBComms as db
+from replies import PendingReplies
 from nlp.sentiment_analysis import SentimentAnalyser
 
 
@@ -55,11 +58,17 @@ class TweetHarvester():
         except:
             raise
 
-        self.db_tweets = db('tweets')
-        self.db_tweets_urls = db('tweets_urls')
-        self.db_tweets_archive = db('tweets_archive')
+        # Tweets arrive from cursors in large numbers, so they are
+        # written in bulk
+        self.db_tweets = db('tweets', bulk_size=100)
+        self.db_tweets_urls = db('tweets_urls', bulk_size=100)
+        self.db_tweets_archive = db('tweets_archive', bulk_size=100)
         self.db_outlets = db('outlets')
         self.db_articles = db('articles')
+        # The replies that still need downloading, see iterate_replies()
+        self.db_replies = db('replies')
+        self.replies = PendingReplies(self.db_replies, self.db_tweets,
+                                      self.db_tweets_archive)
         self.senti = SentimentAnalyser()
 
         self.id_to_outlet = self.db_outlets.get_users()
@@ -102,7 +111,63 @@ class TweetHarvester():
         geocode = {'geojson': g.geojson}
         return geocode
 
-    def store_tweet(self, tweet_status, source=None):
+    def store_tweets(self, tweet_statuses, source=None):
+        """Analyses and stores a batch of tweets in the database.
+
+        Tweets that are already in the tweets or archive database are
+        skipped, so they aren't analysed and geocoded again. Sentiment
+        analysis is then conducted on the whole batch at once before
+        each tweet is passed to store_tweet().
+
+        Args:
+            tweet_statuses (list): tweepy.Status objects.
+            source (dict): Provenance data to store in every tweet.
+        """
+        tweet_statuses = self._new_statuses(tweet_statuses)
+        if not tweet_statuses:
+            return
+        try:
+            sentiments = self.senti.analyse_batch(
+                [t._json['text'] for t in tweet_statuses]
+            )
+        except Exception as e:
+            print(
+                "Warning: Batch sentiment analysis failed, analysing "
+                + "tweets one at a time: "
+                + str(e)
+            )
+            sentiments = [None] * len(tweet_statuses)
+        for tweet_status, sentiment in zip(tweet_statuses, sentiments):
+            try:
+                # store_tweet() modifies the source, so each tweet
+                # needs its own copy
+                self.store_tweet(tweet_status, copy.deepcopy(source),
+                                 sentiment)
+            except:
+                pass
+        self.replies.flush()
+
+    def _new_statuses(self, tweet_statuses):
+        """Returns the statuses that aren't stored yet, looking them up
+        with one request per tweets database.
+        """
+        tweet_statuses = list(tweet_statuses)
+        ids = [t._json['id_str'] for t in tweet_statuses]
+        stored = set()
+        for database in (self.db_tweets, self.db_tweets_archive):
+            try:
+                stored.update(database.get_revs(
+                    [i for i in ids if i not in stored]
+                ))
+            except Exception as e:
+                print(
+                    "Warning: Failed to look up stored tweets: "
+                    + str(e)
+                )
+        return [t for t in tweet_statuses
+                if t._json['id_str'] not in stored]
+
+    def store_tweet(self, tweet_status, source=None, sentiment=None):
         """Analyses and stores a tweet in the database.
 
         This method conducts sentiment analysis and geocoding on the
@@ -111,6 +176,8 @@ class TweetHarvester():
         Args:
             tweet_status (tweepy.Status):
             source (dict): Provenance data to store in the tweet.
+            sentiment (dict): The result of analysing the tweet's text,
+                if it has already been analysed (see store_tweets()).
         """
         # Convert the tweepy Status object into a dict
         tweet_str = json.dumps(tweet_status._json)
@@ -163,7 +230,8 @@ class TweetHarvester():
             print(str(e))
             pass
         # Sentiment analysis
-        sentiment = self.senti.analyse(tweet['text'])
+        if sentiment is None:
+            sentiment = self.senti.analyse(tweet['text'])
         tweet.update(sentiment)
         # Geocoding
         if tweet['coordinates'] is not None:
@@ -179,45 +247,57 @@ class TweetHarvester():
         # If related to an article, store a duplicate of the tweet in
         # the URLs database
         if 'url' in tweet['wa']:
-            response = self.db_tweets_urls.store_tweet(tweet)
-            if response is not None:
-                print("Stored tweet: " + tweet['id_str'] + " in URLs database.")
-        # If the tweet is older than 28 days, store in the archive
+            self.db_tweets_urls.store_tweet(
+                tweet,
+                on_stored=lambda response: print(
+                    "Stored tweet: " + tweet['id_str'] + " in URLs database."
+                )
+            )
+        # If the tweet is older than 28 days, store in the archive. Once
+        # it has been written, record it in the index of pending replies
         oldest_time = int(time.time() - 60*60*24*core.config('twitter', 'days'))
         if (int(tweet['wa']['time']) < oldest_time):
-            response = self.db_tweets_archive.store_tweet(tweet)
-            if response is not None:
-                print("Stored tweet " + tweet['id_str'] + " in archive database.")
+            response = self.db_tweets_archive.store_tweet(
+                tweet,
+                on_stored=functools.partial(self.tweet_stored, tweet,
+                                            "archive database")
+            )
         else:
-            response = self.db_tweets.store_tweet(tweet)
-            if response is not None:
-                print("Stored tweet " + tweet['id_str'] + " in database.")
+            response = self.db_tweets.store_tweet(
+                tweet,
+                on_stored=functools.partial(self.tweet_stored, tweet,
+                                            "database")
+            )
         return response
 
+    def tweet_stored(self, tweet, where, response):
+        """Called once a tweet has been written to the tweets or
+        archive database.
+        """
+        print("Stored tweet " + tweet['id_str'] + " in " + where + ".")
+        self.replies.stored(tweet)
+
     def iterate_timeline(self, user_id):
         """
         """
         # Download the timeline of the user
         try:
             since_id = self._get_since_id(user_id)
-            for tweet in tweepy.Cursor(
+            for page in tweepy.Cursor(
                 self.api.user_timeline,
                 id=user_id,
                 since_id=since_id
-            ).items():
-                try:
-                    source = {'api': self.source_ext['api'][:],
-                              'wa': self.source_ext['wa'].copy()}
-                    source['api'].insert(0, {
-                        'method': 'GET statuses/user_timeline',
-                        'params': {
-                            'user_id': str(user_id),
-                            'since_id': since_id
-                        }
-                    })
-                    self.store_tweet(tweet, source)
-                except:
-                    pass
+            ).pages():
+                source = {'api': self.source_ext['api'][:],
+                          'wa': self.source_ext['wa'].copy()}
+                source['api'].insert(0, {
+                    'method': 'GET statuses/user_timeline',
+                    'params': {
+                        'user_id': str(user_id),
+                        'since_id': since_id
+                    }
+                })
+                self.store_tweets(page, source)
         # Don't need to handle for RateLimitError, Cursor will wait
         except tweepy.TweepError as e:
             print(str(e))
@@ -312,18 +392,17 @@ class TweetHarvester():
             for r in retweets:
                 try:
                     tweets = self.api.retweets(id=r)
-                    for tweet in tweets:
-                        source = {'api': self.source_ext['api'][:],
-                                  'wa': self.source_ext['wa'].copy()}
-                        source['wa']['retweet_of'] = r
-                        source['wa']['retweet_of_outlet'] = retweets[r]
-                        source['api'].insert(0, {
-                            'method': 'GET statuses/retweets/:id',
-                            'params': {
-                                'id': r
-                            }
-                        })
-                        self.store_tweet(tweet, source)
+                    source = {'api': self.source_ext['api'][:],
+                              'wa': self.source_ext['wa'].copy()}
+                    source['wa']['retweet_of'] = r
+                    source['wa']['retweet_of_outlet'] = retweets[r]
+                    source['api'].insert(0, {
+                        'method': 'GET statuses/retweets/:id',
+                        'params': {
+                            'id': r
+                        }
+                    })
+                    self.store_tweets(tweets, source)
                 except:
                     pass
         except:
@@ -338,18 +417,17 @@ class TweetHarvester():
                 outlet = a[url]['outlet']
                 try:
                     tweets = self.api.search(q=url)
-                    for tweet in tweets:
-                        source = {'api': self.source_ext['api'][:],
-                                  'wa': self.source_ext['wa'].copy()}
-                        source['wa']['url'] = url
-                        source['wa']['url_outlet'] = outlet
-                        source['api'].insert(0, {
-                            'method': 'GET search/tweets',
-                            'params': {
-                                'q': url
-                            }
-                        })
-                        self.store_tweet(tweet, source)
+                    source = {'api': self.source_ext['api'][:],
+                              'wa': self.source_ext['wa'].copy()}
+                    source['wa']['url'] = url
+                    source['wa']['url_outlet'] = outlet
+                    source['api'].insert(0, {
+                        'method': 'GET search/tweets',
+                        'params': {
+                            'q': url
+                        }
+                    })
+                    self.store_tweets(tweets, source)
                 except Exception as e:
                     print(str(e))
                     pass
@@ -359,33 +437,36 @@ class TweetHarvester():
 
     def iterate_replies(self):
         """This method downloads tweets that tweets in our database
-        have replied to.
+        have replied to. Only the outstanding replies are read, see
+        replies.PendingReplies.
         """
         try:
-            replies = self.db_tweets.get_replies_full()
-            for r in replies:
-                try:
-                    tweet = self.api.get_status(r)
-                    reply = replies[r]['reply']
-                    reply_user = replies[r]['reply_user']
+            for page in self.replies.iterate():
+                for pending in page:
+                    try:
+                        r = pending['_id']
+                        tweet = self.api.get_status(r)
+                        reply = pending['reply']
+                        reply_user = pending['reply_user']
 
-                    source = {'api': self.source_ext['api'][:],
-                              'wa': self.source_ext['wa'].copy()}
-                    source['reply_status_id'] = int(reply)
-                    source['reply_status_id_str'] = reply
-                    source['reply_user_id'] = int(reply_user)
-                    source['reply_user_id_str'] = reply_user
-                    if reply_user in self.id_to_outlet:
-                        soure['wa']['reply_outlet'] = self.id_to_outlet[reply_user]
-                    source['api'].insert(0, {
-                        'method': 'GET statuses/show/:id',
-                        'params': {
-                            'id': r
-                        }
-                    })
-                    self.store_tweet(tweet, source)
-                except:
-                    pass
+                        source = {'api': self.source_ext['api'][:],
+                                  'wa': self.source_ext['wa'].copy()}
+                        source['reply_status_id'] = int(reply)
+                        source['reply_status_id_str'] = reply
+                        source['reply_user_id'] = int(reply_user)
+                        source['reply_user_id_str'] = reply_user
+                        if reply_user in self.id_to_outlet:
+                            source['wa']['reply_outlet'] = self.id_to_outlet[reply_user]
+                        source['api'].insert(0, {
+                            'method': 'GET statuses/show/:id',
+                            'params': {
+                                'id': r
+                            }
+                        })
+                        self.store_tweet(tweet, source)
+                    except:
+                        pass
+                self.replies.flush()
         except:
             pass
 
@@ -400,6 +481,8 @@ class TweetHarvester():
         melbourneStream = tweepy.Stream(auth = self.api.auth, listener=tweetStreamListener)
         melbourneStream.filter(locations=[144.4441,-38.5030,145.8176,-37.4018], async=True)
 
+# Re-read config.yaml on SIGHUP
+core.install_reload_handler()
 th = TweetHarvester()
 while False:
     th.iterate_timelines()
@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+"""urlindex
+
+An in-process index of the articles already in the database, so that
+each crawl can tell which articles are new without reading the whole
+archive again.
+"""
+
+import hashlib
+
+import core
+
+
+class ArticleIndex():
+    """The set of article URLs stored in a database.
+
+    Article docs use their URL as the _id, so the index is loaded once
+    from _all_docs and then kept up to date from the _changes feed and
+    from add(), which is called after each successful store.
+
+    URLs are kept as 64-bit blake2b hashes rather than strings, which
+    keeps memory use low however long the URLs are. Two URLs would
+    have to share a hash for a new article to be mistaken for an old
+    one, which is vanishingly unlikely at the size of our archive.
+    """
+
+    def __init__(self, db):
+        """
+        Args:
+            db (CouchDBComms): The database of articles.
+        """
+        self.db = db
+        self._hashes = None
+        self._since = None
+
+    def _hash(self, url):
+        digest = hashlib.blake2b(url.encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'little')
+
+    def load(self):
+        """Reads every article _id from the database. The update
+        sequence is read first so that no change made while loading is
+        missed by refresh().
+        """
+        since = self.db.get_update_seq()
+        hashes = set()
+        for _id in self.db.iter_ids():
+            hashes.add(self._hash(_id))
+        self._hashes = hashes
+        self._since = since
+        print(
+            core.dt()
+            + "Loaded "
+            + str(len(hashes))
+            + " articles into the index."
+        )
+
+    def refresh(self):
+        """Applies the changes made to the database since the index was
+        loaded or last refreshed. Loads the index if it hasn't been
+        loaded yet.
+        """
+        if self._hashes is None:
+            self.load()
+            return
+        # Page through the feed until the update sequence stops
+        # advancing. A page can be left empty by design doc changes,
+        # which get_changes() filters out, with more changes after it.
+        while True:
+            changes, since = self.db.get_changes(self._since)
+            for _id, deleted in changes:
+                if deleted is True:
+                    self._hashes.discard(self._hash(_id))
+                else:
+                    self._hashes.add(self._hash(_id))
+            if since == self._since:
+                break
+            self._since = since
+
+    def add(self, url):
+        """Marks an article URL as stored."""
+        if self._hashes is None:
+            self.load()
+        self._hashes.add(self._hash(url))
+
+    def __contains__(self, url):
+        if self._hashes is None:
+            self.load()
+        return self._hash(url) in self._hashes
+
+    def __len__(self):
+        if self._hashes is None:
+            self.load()
+        return len(self._hashes)
@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+"""Benchmark for extract.parse_html().
+
+Compares the pages/sec of extract.parse_html() against the BeautifulSoup
+extraction that OGHarvester.parse_article() used before it (kept below
+for reference) and checks that both produce identical meta and text.
+
+Usage:
+    python3 scripts/bench_parse_article.py [corpus_dir]
+
+corpus_dir should contain saved article pages (*.html, *.htm), e.g.
+downloaded with wget. Synthetic pages are used if no directory is
+passed.
+"""
+
+import os
+import re
+import sys
+import time
+import random
+
+from bs4 import BeautifulSoup
+
+sys.path.append(os.path.join(os.path.dirname(sys.path[0]), 'harvester'))
+
+import core
+import extract
+
+
+def legacy_parse_html(html, media=None):
+    soup = BeautifulSoup(html, 'lxml')
+    metatags = soup.findAll('meta')
+    meta = {}
+    for m in metatags:
+        for attr in ['property', 'name']:
+            if m.has_attr(attr):
+                meta[m[attr]] = m['content']
+                for ext in ['.jpg', '.jpeg', '.gif', '.png',
+                    '.bmp', '.tiff']:
+                    if re.search(ext, m['content'].lower()) is not None:
+                        if media is not None:
+                            media.add(m['content'])
+    try:
+        meta = core.split_namespace(meta)
+    except Exception as e:
+        print(str(e))
+    if soup.find('title') is not None:
+        meta['title'] = soup.find('title').string
+    if soup.find('article') is not None:
+        soup_small = soup.find('article')
+    elif soup.find('body') is not None:
+        soup_small = soup.find('body')
+    else:
+        soup_small = soup
+    for e in soup_small(['head', 'header', 'nav', 'aside', 'footer',
+                         'script', 'noscript', 'style', 'meta', 'button',
+                         'source', 'img', 'path', 'svg', 'form', 'embed',
+                         'menu', 'iframe']):
+        e.extract()
+    text = soup_small.get_text()
+    lines = (line.strip() for line in text.splitlines())
+    chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
+    text = '\n'.join(chunk for chunk in chunks if chunk)
+    return {'meta': meta, 'text': text}
+
+
+def synthetic_pages(n):
+    random.seed(0)
+    words = ['budget', 'Treasurer', 'the', 'a', 'senate', 'vote', '2016',
+             'policy', 'said', 'on', '&amp;', 'café']
+    pages = []
+    for i in range(n):
+        paragraphs = ''.join(
+            '<p>' + ' '.join(random.choice(words) for _ in range(60))
+            + ' <a href="/x">link</a> <b>bold</b>  text</p>\n'
+            for _ in range(20)
+        )
+        page = (
+            '<!DOCTYPE html><html><head><meta charset="utf-8">'
+            '<title>Article ' + str(i) + '</title>'
+            '<meta property="og:title" content="Article ' + str(i) + '">'
+            '<meta property="og:image" content="https://img.example.com/'
+            + str(i) + '.jpg">'
+            '<meta name="twitter:card" content="summary">'
+            '<meta name="description" content="An article">'
+            '<script>var s = "<p>not text</p>";</script>'
+            '<style>p { color: red; }</style></head><body>'
+            '<header><nav><ul><li>Home</li><li>News</li></ul></nav></header>'
+            '<article><h1>Article ' + str(i) + '</h1>' + paragraphs
+            + '<aside>Related</aside><img src="a.jpg">'
+            '<form><button>Share</button></form></article>'
+            '<footer>Copyright</footer></body></html>'
+        )
+        pages.append(page.encode('utf-8'))
+    return pages
+
+
+def load_corpus(path):
+    pages = []
+    for root, dirs, files in os.walk(path):
+        for name in sorted(files):
+            if name.endswith(('.html', '.htm')):
+                with open(os.path.join(root, name), 'rb') as f:
+                    pages.append(f.read())
+    return pages
+
+
+def bench(parse, pages, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for p in pages:
+            try:
+                parse(p)
+            except Exception:
+                pass
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(pages) / best
+
+
+def run(parse, page):
+    media = set()
+    try:
+        return parse(page, media), media
+    except Exception as e:
+        return type(e).__name__, media
+
+
+def main():
+    if len(sys.argv) > 1:
+        pages = load_corpus(sys.argv[1])
+    else:
+        pages = synthetic_pages(200)
+    mismatches = sum(
+        1 for p in pages
+        if run(legacy_parse_html, p) != run(extract.parse_html, p)
+    )
+    print('pages:      ' + str(len(pages)))
+    print('mismatches: ' + str(mismatches))
+    before = bench(legacy_parse_html, pages)
+    after = bench(extract.parse_html, pages)
+    print('before:     {0:.1f} pages/sec'.format(before))
+    print('after:      {0:.1f} pages/sec'.format(after))
+    print('speedup:    {0:.2f}x'.format(after / before))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+"""Micro-benchmark for nlp.tokenizer.
+
+Compares the tokens/sec of nlp.tokenizer against the feature extraction
+that SentimentAnalyser used before it (kept below for reference) and
+checks that both produce identical features.
+
+Usage:
+    python3 scripts/bench_tokenizer.py [tweets.txt]
+
+tweets.txt should contain one tweet per line. Synthetic tweets are used
+if no file is passed.
+"""
+
+import os
+import re
+import sys
+import time
+import random
+import string
+
+sys.path.append(os.path.join(os.path.dirname(sys.path[0]), 'harvester'))
+
+from nlp import tokenizer
+
+
+def legacy_process_tweet(tweet):
+    tweet = tweet.lower()
+    tweet = re.sub('((www\.[^\s]+)|(https?://[^\s]+))', 'URL', tweet)
+    tweet = re.sub('@[^\s]+', 'AT_USER', tweet)
+    tweet = re.sub('[\s]+', ' ', tweet)
+    tweet = re.sub(r'#([^\s]+)', r'\1', tweet)
+    tweet = tweet.strip('\'"')
+    return tweet
+
+
+def legacy_get_feature_vector(tweet, stop_words):
+    feature_vector = []
+    words = tweet.split()
+    for w in words:
+        pattern = re.compile(r"(.)\1{1,}", re.DOTALL)
+        w = pattern.sub(r"\1\1", w)
+        w = w.strip('\'"?,.')
+        val = re.search(r"^[a-zA-Z][a-zA-Z0-9]*$", w)
+        if (w in stop_words or val is None):
+            continue
+        else:
+            feature_vector.append(w.lower())
+    return feature_vector
+
+
+def synthetic_tweets(n):
+    random.seed(0)
+    words = ['good', 'baaaad', 'happy', 'Sad', 'love', 'the', 'a', 'is',
+             'news', 'today', 'RT', 'sooooo', 'great!!!', '"quoted"',
+             'it\'s', 'wow.', 'vote', '2016', 'x1', '...']
+    extras = ['@user', '@user#tag', '#tag', '#@user', '#www.x.com',
+              'http://t.co/abc', 'www.example.com/a', 'a#b#c', '\t']
+    tweets = []
+    for _ in range(n):
+        tweet = [random.choice(words + extras) for _ in range(18)]
+        tweets.append(' '.join(tweet))
+    return tweets
+
+
+def bench(tokenize, tweets, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        tokens = 0
+        for t in tweets:
+            tokens += len(t.split())
+            tokenize(t)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return tokens / best
+
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as f:
+            tweets = [line.rstrip('\n') for line in f]
+    else:
+        tweets = synthetic_tweets(20000)
+
+    stop_words_list = list(tokenizer.get_stop_words())
+    stop_words = tokenizer.get_stop_words()
+
+    def legacy(t):
+        return legacy_get_feature_vector(legacy_process_tweet(t),
+                                         stop_words_list)
+
+    def current(t):
+        return tokenizer.tokenize(t, stop_words)
+
+    for t in tweets:
+        if legacy(t) != current(t):
+            print("Feature mismatch for tweet: " + repr(t))
+            sys.exit(1)
+
+    legacy_rate = bench(legacy, tweets)
+    current_rate = bench(current, tweets)
+    print("tweets:    " + str(len(tweets)))
+    print("legacy:    {:,.0f} tokens/sec".format(legacy_rate))
+    print("tokenizer: {:,.0f} tokens/sec".format(current_rate))
+    print("speedup:   {:.2f}x".format(current_rate / legacy_rate))
+
+
+if __name__ == '__main__':
+    main()
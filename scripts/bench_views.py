@@ -0,0 +1,209 @@
+#!/usr/bin/python3
+"""Benchmark for the tweets design document.
+
+Fills a scratch database on the configured CouchDB server with
+synthetic tweets and times how long CouchDB takes to build the index
+of the tweets views, and how long get_since_ids() and
+get_replies_full() take to query them, first with the JavaScript
+reduces they used before (kept below for reference) and then with the
+current views. Checks that get_since_ids() and get_replies_full()
+return the same as the legacy queries. The scratch database is deleted afterwards.
+
+Usage:
+    python3 scripts/bench_views.py [tweets]
+
+tweets is the number of synthetic tweets, 100000 by default.
+"""
+
+import os
+import sys
+import time
+import random
+
+sys.path.append(os.path.join(os.path.dirname(sys.path[0]), 'harvester'))
+
+from comms import couchdb as comms
+
+SCRATCH_DB = 'bench_views'
+
+LEGACY_USERS_SINCE_ID_MAP = '''function (doc) {
+  if (doc.api[0].method == 'GET statuses/user_timeline') {
+    emit(doc.user.id_str, doc._id)
+  }
+}
+'''
+
+LEGACY_USERS_SINCE_ID_REDUCE = '''function (key, values, rereduce) {
+  var max = -Infinity
+  for (var i = 0; i < values.length; i++)
+    if (values[i] > max)
+      max = values[i]
+  return max
+}
+'''
+
+LEGACY_REPLIES_FULL_REDUCE = '''function(keys, values, rereduce) {
+  var have_doc = false;
+  for (i=0;i<values.length;i++) {
+    if (values[i] == 0) {
+      have_doc = true;
+    }
+  }
+  if (have_doc) {
+    return 0;
+  } else {
+    return 1;
+  }
+}
+'''
+
+
+def legacy_views():
+    views = {name: dict(view)
+             for name, view in comms.VIEWS['tweets'].items()}
+    views['users_since_id'] = {'map': LEGACY_USERS_SINCE_ID_MAP,
+                               'reduce': LEGACY_USERS_SINCE_ID_REDUCE}
+    views['replies_full']['reduce'] = LEGACY_REPLIES_FULL_REDUCE
+    return views
+
+
+def legacy_get_since_ids(db):
+    queue = {}
+    for row in db.view('tweets/users_since_id', wrapper=None,
+                       group='true'):
+        queue.update({row.key: row.value})
+    return queue
+
+
+def legacy_get_replies_full(db):
+    queue = {}
+    for row in db.view('tweets/replies_full', wrapper=None,
+                       group_level=1):
+        if (row.value == 1):
+            queue.update({row.key[0]: {}})
+    for row in db.view('tweets/replies_full', wrapper=None,
+                       group='true'):
+        if row.key[0] in queue:
+            queue[row.key[0]]['reply'] = row.key[1]
+            queue[row.key[0]]['reply_user'] = row.key[2]
+    return queue
+
+
+def synthetic_tweets(n):
+    random.seed(0)
+    users = [str(random.randrange(10 ** 6, 10 ** 10)) for _ in range(200)]
+    words = ['news', 'vote', 'today', 'election', 'budget', 'sport']
+    tweets = []
+    ids = []
+    for i in range(n):
+        # IDs of different lengths, so that string and numeric order
+        # disagree
+        id_str = str(random.randrange(10 ** 15, 10 ** 18))
+        method = random.choice(['GET statuses/user_timeline',
+                                'GET search/tweets'])
+        tweet = {
+            '_id': id_str,
+            'id_str': id_str,
+            'user': {'id_str': random.choice(users)},
+            'api': [{'method': method}],
+            'entities': {'urls': [{
+                'expanded_url': 'http://example.com/' + str(i % 5000)
+            }]},
+            'features': random.sample(words, 2),
+            'wa': {'url': 'http://example.com/' + str(i % 5000),
+                   'time': str(1500000000 + i)}
+        }
+        if ids and random.random() < 0.3:
+            # Replies to tweets that may or may not be stored
+            tweet['in_reply_to_user_id_str'] = random.choice(users)
+            tweet['in_reply_to_status_id_str'] = random.choice([
+                random.choice(ids),
+                str(random.randrange(10 ** 15, 10 ** 18))
+            ])
+        ids.append(id_str)
+        tweets.append(tweet)
+    return tweets
+
+
+def build_index(db, views):
+    """Saves a design document and returns the number of seconds
+    CouchDB takes to build its index.
+    """
+    doc = {'_id': '_design/tweets', 'language': 'javascript',
+           'views': views}
+    if doc['_id'] in db:
+        doc['_rev'] = db[doc['_id']].rev
+    db.save(doc)
+    start = time.perf_counter()
+    # Every view in a design document shares one index
+    for row in db.view('tweets/' + sorted(views)[0], wrapper=None,
+                       limit=0):
+        pass
+    return time.perf_counter() - start
+
+
+def timed(function, *args):
+    """Returns the result of a function and the seconds it took."""
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    server = comms.get_server()
+    if SCRATCH_DB in server:
+        del server[SCRATCH_DB]
+    db = server.create(SCRATCH_DB)
+    try:
+        tweets = synthetic_tweets(n)
+        for i in range(0, len(tweets), 1000):
+            db.update(tweets[i:i + 1000])
+
+        legacy_time = build_index(db, legacy_views())
+        legacy_since_ids, legacy_since_time = timed(
+            legacy_get_since_ids, db
+        )
+        legacy_replies, legacy_replies_time = timed(
+            legacy_get_replies_full, db
+        )
+
+        current_time = build_index(db, comms.VIEWS['tweets'])
+        bench = comms.CouchDBComms(SCRATCH_DB)
+        # The legacy reduce compared the IDs as strings, so check the
+        # users against it but the IDs against the numeric maximum. The
+        # since_id must be below the maximum, by no more than the margin
+        # and the rounding error.
+        expected = {}
+        for t in tweets:
+            if t['api'][0]['method'] == 'GET statuses/user_timeline':
+                user_id = t['user']['id_str']
+                expected[user_id] = max(int(t['id_str']),
+                                        expected.get(user_id, 0))
+        since_ids, since_time = timed(bench.get_since_ids)
+        if set(since_ids) != set(legacy_since_ids) or any(
+            not (0 < expected[u] - int(since_ids[u])
+                 <= 2 * comms.SINCE_ID_MARGIN)
+            for u in since_ids
+        ):
+            print("get_since_ids() mismatch")
+            sys.exit(1)
+        replies, replies_time = timed(bench.get_replies_full)
+        if set(replies) != set(legacy_replies):
+            print("get_replies_full() mismatch")
+            sys.exit(1)
+    finally:
+        del server[SCRATCH_DB]
+
+    print("tweets:  " + str(n))
+    print("legacy:  {:.1f}s to build the index, {:.3f}s get_since_ids(), "
+          "{:.3f}s get_replies_full()".format(
+              legacy_time, legacy_since_time, legacy_replies_time))
+    print("current: {:.1f}s to build the index, {:.3f}s get_since_ids(), "
+          "{:.3f}s get_replies_full()".format(
+              current_time, since_time, replies_time))
+    print("speedup: {:.2f}x".format(legacy_time / current_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+"""Golden output tests for feeds.tag_to_dict().
+
+Each feed in tests/data has the dicts its <url> or <item> tags were
+converted to before tag_to_dict() replaced the recursive
+OGHarvester.parse_tag(): <name>.bs4.json for the BeautifulSoup trees
+the harvester used to parse feeds into, and <name>.lxml.json for the
+streaming lxml parser. The two differ where BeautifulSoup does (CDATA
+sections in sitemaps, empty attribute tags and the '' prefix of RSS 1.0
+tags).
+
+Run with:
+    python3 -m unittest discover tests
+"""
+
+import os
+import sys
+import json
+import unittest
+
+from bs4 import BeautifulSoup
+from lxml import etree
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(os.path.dirname(TESTS), 'harvester'))
+
+import feeds
+
+DATA = os.path.join(TESTS, 'data')
+# Feed name: True for sitemaps, False for RSS feeds
+FEEDS = {
+    'news_sitemap': True,
+    'wordpress_rss': False,
+    'rdf_feed': False,
+    'media_rss': False
+}
+# Fields iter_feed() adds to the converted tags
+ADDED = ('crawl', 'lastmod_time', 'pubDate_time')
+
+
+def read(name, ext):
+    with open(os.path.join(DATA, name + ext), 'rb') as f:
+        return f.read()
+
+
+def golden(name, tree):
+    return json.loads(read(name, '.' + tree + '.json').decode('utf-8'))
+
+
+class TestTagToDict(unittest.TestCase):
+
+    def test_bs4(self):
+        for name, sitemap in FEEDS.items():
+            content = read(name, '.xml')
+            # Parse the feed as the harvester did with BeautifulSoup
+            if sitemap:
+                tags = [
+                    u for u in BeautifulSoup(content, 'lxml').findAll('url')
+                    if u.find('loc') is not None
+                ]
+            else:
+                tags = [
+                    i for i in BeautifulSoup(content, 'xml').findAll('item')
+                    if i.find('link') is not None
+                ]
+            result = [feeds.tag_to_dict(t) for t in tags]
+            self.assertEqual(result, golden(name, 'bs4'), name)
+
+    def test_bs4_tree_unchanged(self):
+        soup = BeautifulSoup(read('media_rss', '.xml'), 'xml')
+        before = str(soup)
+        for item in soup.findAll('item'):
+            feeds.tag_to_dict(item)
+        self.assertEqual(str(soup), before)
+
+    def test_lxml_stream(self):
+        for name in FEEDS:
+            content = read(name, '.xml')
+            # Feed the document in small chunks, as if downloading it
+            chunks = [content[i:i + 64] for i in range(0, len(content), 64)]
+            result = []
+            for article in feeds.iter_feed(chunks, 'http://test/' + name):
+                if 'sitemap' in article:
+                    tag_dict = article['sitemap']
+                else:
+                    tag_dict = article['rss']['item']
+                for field in ADDED:
+                    tag_dict.pop(field, None)
+                result.append(tag_dict)
+            self.assertEqual(result, golden(name, 'lxml'), name)
+
+    def test_namespaces_and_duplicates(self):
+        content = (
+            b'<item xmlns:media="http://search.yahoo.com/mrss/">'
+            b'<link>http://a/1</link><title>One</title>'
+            b'<media:content url="http://a/1.jpg"><media:title>A</media:title>'
+            b'</media:content><media:content url="http://a/2.jpg"/>'
+            b'<category>x</category><category>y</category></item>'
+        )
+        element = etree.fromstring(content)
+        self.assertEqual(feeds.tag_to_dict(element), {
+            'media': {'content': [
+                {'title': 'A'},
+                {'url': 'http://a/2.jpg', 'content': None}
+            ]},
+            'link': 'http://a/1',
+            'title': 'One',
+            'category': ['x', 'y']
+        })
+
+    def test_deep(self):
+        # Deeper than the recursion limit
+        root = element = etree.Element('item')
+        for i in range(sys.getrecursionlimit() + 100):
+            element = etree.SubElement(element, 'a')
+        element.text = 'x'
+        result = feeds.tag_to_dict(root)
+        depth = 0
+        while isinstance(result, dict):
+            result = result['a']
+            depth += 1
+        self.assertEqual(depth, sys.getrecursionlimit() + 100)
+        self.assertEqual(result, 'x')
+
+    def test_unchanged_sitemap_index(self):
+        index = (
+            b'<sitemapindex xmlns="http://www.sitemaps.org/schemas/'
+            b'sitemap/0.9"><sitemap><loc>http://test/a.xml</loc></sitemap>'
+            b'</sitemapindex>'
+        )
+        sitemap = (
+            b'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+            b'<url><loc>http://test/new</loc></url></urlset>'
+        )
+        fetched = []
+
+        def fetch(url):
+            fetched.append(url)
+            return [sitemap]
+
+        # The index is read in full and its sitemaps are remembered
+        indexes = {}
+        urls = [a['url'] for a in feeds.iter_feed(
+            [index], 'http://test/index.xml', fetch, indexes=indexes
+        )]
+        self.assertEqual(urls, ['http://test/new'])
+        self.assertEqual(indexes, {'http://test/index.xml':
+                                   ['http://test/a.xml']})
+        # The index answers 304 but its sitemap has changed
+        urls = [a['url'] for a in feeds.iter_feed(
+            None, 'http://test/index.xml', fetch, indexes=indexes
+        )]
+        self.assertEqual(urls, ['http://test/new'])
+        self.assertEqual(fetched, ['http://test/a.xml'] * 2)
+        # An unchanged sitemap yields nothing
+        self.assertEqual(list(feeds.iter_feed(
+            None, 'http://test/a.xml', fetch, indexes=indexes
+        )), [])
+
+    def test_many_duplicates(self):
+        item = etree.Element('item')
+        for i in range(1000):
+            etree.SubElement(item, 'category').text = str(i)
+        result = feeds.tag_to_dict(item)
+        self.assertEqual(result['category'], [str(i) for i in range(1000)])
+
+
+if __name__ == '__main__':
+    unittest.main()